@@ -0,0 +1,901 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import socket
+import sqlite3
+import tempfile
+import subprocess
+import json
+import threading
+import random
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import otp_auth_server as server
+
+server.LOG_LEVEL = 'ERROR'
+
+SIZES = [100, 1000, 10000, 100000, 1000000]
+EXPIRING_PER_CALL = 10
+CALLS = 200
+
+def reset_state():
+    server.active_otps.clear()
+    server.otp_requests_by_mac.clear()
+    server.authenticated_clients.clear()
+    server.pending_registrations.clear()
+    server.expiry_heap.clear()
+    server.state_counters.update(used_otps=0, issued=0, verified=0, expired=0)
+
+def full_scan_cleanup():
+    current_time = time.time()
+    expired_otps = [otp for otp, data in server.active_otps.items()
+                    if current_time - data['created'] > server.OTP_VALIDITY]
+    for otp in expired_otps:
+        del server.active_otps[otp]
+
+def add_otp(key, created):
+    server.active_otps[key] = {'otp': '000000', 'email': key, 'created': created, 'used': False, 'mac': None}
+    server.schedule_expiry('otp', key, server.active_otps[key])
+
+def populate(size):
+    now = time.time()
+    for i in range(size):
+        add_otp(f"live-{i}", now)
+
+def bench_cleanup_expired():
+    print("=" * 70)
+    print("cleanup_expired(): expiry index vs. full table scan")
+    print(f"({EXPIRING_PER_CALL} entries expire between consecutive requests)")
+    print("=" * 70)
+    print(f"{'entries':>10} {'indexed us/call':>18} {'full scan us/call':>20}")
+    print("-" * 70)
+
+    for size in SIZES:
+        reset_state()
+        populate(size)
+
+        elapsed = 0.0
+        expired_created = time.time() - server.OTP_VALIDITY - 1
+        for call in range(CALLS):
+            for i in range(EXPIRING_PER_CALL):
+                add_otp(f"dead-{call}-{i}", expired_created)
+            start = time.perf_counter()
+            server.cleanup_expired()
+            elapsed += time.perf_counter() - start
+        indexed = elapsed / CALLS * 1e6
+
+        scan_calls = max(1, min(CALLS, 1000000 // size))
+        start = time.perf_counter()
+        for _ in range(scan_calls):
+            full_scan_cleanup()
+        scanned = (time.perf_counter() - start) / scan_calls * 1e6
+
+        print(f"{size:>10} {indexed:>18.1f} {scanned:>20.1f}")
+
+    reset_state()
+    print("=" * 70)
+
+ROUTER_LOGINS = 500
+ROUTER_LATENCY = 0.02
+
+class StandInRouter(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = ROUTER_LATENCY
+    round_trips = 0
+    clients = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply(self, payload):
+        StandInRouter.round_trips += 1
+        time.sleep(self.latency)
+        self.send_json(payload)
+
+    def do_GET(self):
+        if self.path.startswith('/neighbors'):
+            # Neighbor table polls are not authorization round trips
+            self.send_json({'boot': 'stand-in', 'version': 0, 'full': True, 'set': {}, 'remove': []})
+            return
+        self.reply({'status': 'success'})
+
+    def do_POST(self):
+        lines = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode().splitlines()
+        results = [{'mac': line.split()[0], 'status': 'success'} for line in lines if line.strip()]
+        StandInRouter.clients += len(results)
+        self.reply({'status': 'success', 'failed': 0, 'results': results})
+
+def start_stand_in_router():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandInRouter)
+    httpd.daemon_threads = True
+    httpd.handle_error = lambda request, client_address: None
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    server.ROUTER_AUTH_URL = f"http://127.0.0.1:{httpd.server_address[1]}/cgi-bin/auth"
+    return httpd
+
+def authenticate_on_router(mac, ip=None):
+    # One GET per client, as the server did before batching
+    params = {'action': 'auth', 'mac': mac, 'ip': ip} if ip else {'action': 'auth', 'mac': mac}
+    try:
+        response = server.router_session.get(server.ROUTER_AUTH_URL, params=params, timeout=server.ROUTER_TIMEOUT)
+        return response.status_code == 200 and response.json().get('status') == 'success'
+    except requests.RequestException:
+        return False
+
+def bench_router_dispatch():
+    print("=" * 70)
+    print(f"Router authorization: {ROUTER_LOGINS} logins, {ROUTER_LATENCY * 1000:.0f} ms router latency")
+    print("=" * 70)
+
+    httpd = start_stand_in_router()
+    macs = [f"02:00:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}" for i in range(ROUTER_LOGINS)]
+
+    StandInRouter.round_trips = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=50) as pool:
+        list(pool.map(lambda mac: authenticate_on_router(mac, '10.0.10.100'), macs))
+    direct = time.perf_counter() - start
+    direct_trips = StandInRouter.round_trips
+
+    StandInRouter.round_trips = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=50) as pool:
+        list(pool.map(lambda mac: server.router_dispatcher.submit('auth', mac, '10.0.10.100'), macs))
+    server.router_dispatcher.queue.join()
+    batched = time.perf_counter() - start
+    batched_trips = StandInRouter.round_trips
+
+    httpd.shutdown()
+    print(f"{'mode':<24} {'round trips':>12} {'wall time s':>14}")
+    print("-" * 70)
+    print(f"{'one call per login':<24} {direct_trips:>12} {direct:>14.2f}")
+    print(f"{'batched dispatcher':<24} {batched_trips:>12} {batched:>14.2f}")
+    print("=" * 70)
+
+BULK_SIZES = [1000, 5000]
+
+def bench_admin_bulk():
+    print("=" * 70)
+    print(f"Event onboarding and closing: {ROUTER_LATENCY * 1000:.0f} ms router latency, in-memory state")
+    print("=" * 70)
+    print(f"{'clients':>8} {'mode':<28} {'round trips':>12} {'wall time ms':>14}")
+    print("-" * 70)
+
+    httpd = start_stand_in_router()
+    StandInRouter.latency = ROUTER_LATENCY
+    server.ADMIN_TOKEN = 'benchmark'
+    client = server.app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = f"Bearer {server.ADMIN_TOKEN}"
+    for size in BULK_SIZES:
+        macs = [f"02:0b:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}" for i in range(size)]
+
+        StandInRouter.round_trips = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=50) as pool:
+            list(pool.map(authenticate_on_router, macs))
+        rows = [('authenticate_on_router each', StandInRouter.round_trips, time.perf_counter() - start)]
+
+        for action in ('auth', 'deauth'):
+            StandInRouter.round_trips = 0
+            start = time.perf_counter()
+            result = client.post(f"/api/admin/bulk_{action}", json=macs).get_json()
+            if result['succeeded'] != size:
+                raise RuntimeError(f"bulk_{action} did not succeed for every client: {result['failed']} failed")
+            rows.append((f"bulk_{action}", StandInRouter.round_trips, time.perf_counter() - start))
+
+        for name, trips, elapsed in rows:
+            print(f"{size:>8} {name:<28} {trips:>12} {elapsed * 1000:>14.1f}")
+
+    reset_state()
+    httpd.shutdown()
+    print("=" * 70)
+
+AGENT_CLIENTS = 300
+AGENT_CONCURRENCY = 16
+ROUTER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'router')
+STAND_IN_TOOL = """#!/bin/sh
+echo "$0" >> "{log}"
+[ "$1" = restore ] && cat > /dev/null
+exit 0
+"""
+
+def stand_in_tools(workdir):
+    # ipset and logger stand-ins that only record each process start
+    log = os.path.join(workdir, 'calls')
+    for tool in ('ipset', 'logger'):
+        path = os.path.join(workdir, tool)
+        with open(path, 'w') as tool_file:
+            tool_file.write(STAND_IN_TOOL.format(log=log))
+        os.chmod(path, 0o755)
+    open(log, 'w').close()
+    return log
+
+def count_lines(path):
+    with open(path) as log:
+        return sum(1 for _ in log)
+
+def bench_router_agent():
+    print("=" * 70)
+    print(f"Router-side authorization of {AGENT_CLIENTS} clients (ipset mode, stand-in ipset)")
+    print("=" * 70)
+
+    workdir = tempfile.mkdtemp()
+    log = stand_in_tools(workdir)
+    env = dict(os.environ, PATH=f"{workdir}:{os.environ['PATH']}")
+    conf = os.path.join(workdir, 'captive.conf')
+    with open(conf, 'w') as conf_file:
+        conf_file.write("CAPTIVE_MODE=ipset\n")
+
+    def macs(prefix):
+        return [f"02:{prefix:02x}:00:00:{i >> 8 & 0xff:02x}:{i & 0xff:02x}" for i in range(AGENT_CLIENTS)]
+
+    def fork_per_client(mac):
+        subprocess.run(['sh', os.path.join(ROUTER_DIR, 'usr', 'bin', 'captive-auth'), 'auth', mac, '10.0.10.100'],
+                       env=env, stdout=subprocess.DEVNULL, check=True)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=AGENT_CONCURRENCY) as pool:
+        list(pool.map(fork_per_client, macs(1)))
+    rows = [('captive-auth per client', time.perf_counter() - start, count_lines(log) + AGENT_CLIENTS)]
+
+    port = free_port()
+    agent = subprocess.Popen([sys.executable, os.path.join(ROUTER_DIR, 'usr', 'bin', 'captive-agent'),
+                              '--conf', conf, '--addr', '127.0.0.1', '--port', str(port)],
+                             env=env, stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}/auth"
+    try:
+        wait_for_server(f"http://127.0.0.1:{port}")
+        sessions = threading.local()
+
+        def agent_request(mac):
+            if not hasattr(sessions, 'session'):
+                sessions.session = requests.Session()
+            sessions.session.get(url, params={'action': 'auth', 'mac': mac, 'ip': '10.0.10.100'}).raise_for_status()
+
+        def one_call_each():
+            with ThreadPoolExecutor(max_workers=AGENT_CONCURRENCY) as pool:
+                list(pool.map(agent_request, macs(2)))
+
+        def one_batch():
+            requests.post(f"{url}?action=auth", data=''.join(f"{mac} 10.0.10.100\n" for mac in macs(3))).raise_for_status()
+
+        for name, run in (('agent, one call each', one_call_each), ('agent, one batch', one_batch)):
+            before = count_lines(log)
+            start = time.perf_counter()
+            run()
+            rows.append((name, time.perf_counter() - start, count_lines(log) - before))
+    finally:
+        agent.terminate()
+        agent.wait(10)
+
+    print(f"{'mode':<26} {'wall time ms':>14} {'per client ms':>15} {'processes':>10}")
+    print("-" * 70)
+    for name, elapsed, processes in rows:
+        print(f"{name:<26} {elapsed * 1000:>14.1f} {elapsed / AGENT_CLIENTS * 1000:>15.2f} {processes:>10}")
+    print("=" * 70)
+
+DETECT_SIZES = [10, 1000, 10000]
+DETECT_PROBES = 50
+LEGACY_DETECT = """#!/bin/sh
+CLIENT_IP="${{REMOTE_ADDR}}"
+CLIENT_MAC=$(cat {arp} | grep "^${{CLIENT_IP}}" | grep -v "00:00:00:00:00:00" | awk '{{print $4}}' | head -1)
+IS_AUTH=$(iptables -L CAPTIVE_ACCEPT -n | grep -i "$CLIENT_MAC" | wc -l)
+echo "$IS_AUTH"
+"""
+
+def bench_captive_detect():
+    print("=" * 70)
+    print("captive-detect probe latency vs. authorized clients (stand-in ip/iptables)")
+    print("=" * 70)
+    print(f"{'clients':>10} {'arp + iptables -L ms':>22} {'client map ms':>15}")
+    print("-" * 70)
+
+    with open(os.path.join(ROUTER_DIR, 'www', 'cgi-bin', 'captive-detect')) as script:
+        detect = script.read().replace('/etc/captive.conf', '/nonexistent/captive.conf')
+
+    for size in DETECT_SIZES:
+        workdir = tempfile.mkdtemp()
+        neigh = os.path.join(workdir, 'neigh')
+        mac_dir = os.path.join(workdir, 'map', 'mac')
+        os.makedirs(neigh)
+        os.makedirs(mac_dir)
+
+        clients = [(f"10.0.{i >> 8 & 0xff}.{i & 0xff}", f"02:00:00:00:{i >> 8 & 0xff:02x}:{i & 0xff:02x}") for i in range(size)]
+        with open(os.path.join(workdir, 'arp'), 'w') as arp, open(os.path.join(workdir, 'rules'), 'w') as rules:
+            arp.write("IP address       HW type     Flags       HW address            Mask     Device\n")
+            for ip, mac in clients:
+                arp.write(f"{ip:<16} 0x1         0x2         {mac}     *        eth1\n")
+                rules.write(f"    0     0 ACCEPT     all  --  *      *       0.0.0.0/0            0.0.0.0/0            MAC {mac.upper()}\n")
+                with open(os.path.join(neigh, ip), 'w') as entry:
+                    entry.write(f"{mac}\n")
+                open(os.path.join(mac_dir, mac), 'w').close()
+
+        tools = {
+            'ip': f'#!/bin/sh\n[ -f "{neigh}/$3" ] && read mac < "{neigh}/$3" && echo "$3 dev eth1 lladdr $mac REACHABLE"\n',
+            'iptables': f'#!/bin/sh\ncat "{workdir}/rules"\n',
+            'legacy-detect': LEGACY_DETECT.format(arp=os.path.join(workdir, 'arp')),
+            'captive-detect': detect.replace('CAPTIVE_MAP_DIR=/tmp/captive', f"CAPTIVE_MAP_DIR={workdir}/map")
+        }
+        for name, content in tools.items():
+            with open(os.path.join(workdir, name), 'w') as tool:
+                tool.write(content)
+            os.chmod(os.path.join(workdir, name), 0o755)
+
+        # Probe from the most recently authorized client, the last one any scan reaches
+        env = dict(os.environ, PATH=f"{workdir}:{os.environ['PATH']}", REMOTE_ADDR=clients[-1][0], REQUEST_URI='/generate_204')
+        timings = []
+        for script in ('legacy-detect', 'captive-detect'):
+            output = subprocess.run([os.path.join(workdir, script)], env=env, capture_output=True, text=True).stdout
+            if output.strip() not in ('1', 'Status: 204 No Content\nCache-Control: no-cache'):
+                raise RuntimeError(f"{script} did not see the client as authorized: {output!r}")
+            start = time.perf_counter()
+            for _ in range(DETECT_PROBES):
+                subprocess.run([os.path.join(workdir, script)], env=env, stdout=subprocess.DEVNULL)
+            timings.append((time.perf_counter() - start) / DETECT_PROBES * 1000)
+
+        print(f"{size:>10} {timings[0]:>22.2f} {timings[1]:>15.2f}")
+
+    print("=" * 70)
+
+PROXY_LOGINS = 300
+PROXY_CONCURRENCY = 16
+PROXY_CLIENT_MAC = '02:aa:00:00:00:01'
+
+class StandInAPI(BaseHTTPRequestHandler):
+    # OTP server stand-in that counts the connections the proxy opens
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    connections = 0
+    forwarded = set()
+
+    def setup(self):
+        super().setup()
+        StandInAPI.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self):
+        StandInAPI.forwarded.add((self.headers.get('X-Forwarded-For'), self.headers.get('X-Client-MAC')))
+        body = json.dumps({'success': True, 'mac': self.headers.get('X-Client-MAC')}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply()
+
+class StandInCGI(BaseHTTPRequestHandler):
+    # Runs /www/cgi-bin/api-proxy once per request the way uhttpd does
+    protocol_version = 'HTTP/1.1'
+    script = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        env = dict(os.environ, REQUEST_METHOD='POST', PATH_INFO=self.path.split('/api-proxy', 1)[1],
+                   REMOTE_ADDR=self.client_address[0], CONTENT_LENGTH=str(len(body)),
+                   CONTENT_TYPE=self.headers.get('Content-Type', ''))
+        output = subprocess.run(['sh', self.script], input=body, env=env, capture_output=True).stdout
+        headers, _, payload = output.partition(b'\n\n')
+        self.send_response(200)
+        for line in headers.decode().splitlines():
+            name, _, value = line.partition(': ')
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def start_server(handler):
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+def bench_api_proxy():
+    print("=" * 70)
+    print(f"Splash page API proxy: {PROXY_LOGINS} logins (2 calls each), {PROXY_CONCURRENCY} at once, stand-in OTP server")
+    print("=" * 70)
+
+    api = start_server(StandInAPI)
+    upstream = f"http://127.0.0.1:{api.server_address[1]}"
+    workdir = tempfile.mkdtemp()
+
+    with open(os.path.join(ROUTER_DIR, 'www', 'cgi-bin', 'api-proxy')) as script:
+        cgi = script.read().replace('http://192.168.56.1:5000', upstream)
+    StandInCGI.script = os.path.join(workdir, 'api-proxy')
+    with open(StandInCGI.script, 'w') as script:
+        script.write(cgi)
+    cgi_server = start_server(StandInCGI)
+
+    leases = os.path.join(workdir, 'dhcp.leases')
+    with open(leases, 'w') as leases_file:
+        leases_file.write(f"0 {PROXY_CLIENT_MAC} 127.0.0.1 client *\n")
+    conf = os.path.join(workdir, 'captive.conf')
+    with open(conf, 'w') as conf_file:
+        conf_file.write(f"CAPTIVE_LEASES={leases}\nCAPTIVE_PROXY_UPSTREAM={upstream}\n")
+    proxy_port = free_port()
+    agent = subprocess.Popen([sys.executable, os.path.join(ROUTER_DIR, 'usr', 'bin', 'captive-agent'),
+                              '--conf', conf, '--addr', '127.0.0.1', '--port', str(free_port()),
+                              '--proxy-addr', '127.0.0.1', '--proxy-port', str(proxy_port)],
+                             stdout=subprocess.DEVNULL)
+
+    def run(base_url):
+        latencies = []
+
+        def login(i):
+            # Each login is one browser tab keeping its connection to the router open
+            session = requests.Session()
+            for endpoint, payload in (('request_otp', {'email': f"user{i}@example.com"}), ('verify_otp', {'otp': '123456'})):
+                start = time.perf_counter()
+                session.post(f"{base_url}/{endpoint}", json=payload, timeout=30).raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        StandInAPI.connections = 0
+        StandInAPI.forwarded = set()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=PROXY_CONCURRENCY) as pool:
+            list(pool.map(login, range(PROXY_LOGINS)))
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        return (elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)],
+                StandInAPI.connections, StandInAPI.forwarded)
+
+    try:
+        wait_for_server(f"http://127.0.0.1:{proxy_port}")
+        rows = [
+            ('curl per request (CGI)', run(f"http://127.0.0.1:{cgi_server.server_address[1]}/cgi-bin/api-proxy")),
+            ('captive-agent proxy', run(f"http://127.0.0.1:{proxy_port}/api"))
+        ]
+    finally:
+        agent.terminate()
+        agent.wait(10)
+        cgi_server.shutdown()
+        api.shutdown()
+
+    print(f"{'mode':<24} {'wall time ms':>13} {'p50 ms':>8} {'p99 ms':>8} {'upstream conns':>15}")
+    print("-" * 70)
+    for name, (elapsed, p50, p99, connections, _) in rows:
+        print(f"{name:<24} {elapsed * 1000:>13.1f} {p50 * 1000:>8.2f} {p99 * 1000:>8.2f} {connections:>15}")
+    print("-" * 70)
+    for name, (*_, forwarded) in rows:
+        print(f"{name:<24} forwarded (client IP, MAC): {', '.join(f'{ip} {mac}' for ip, mac in sorted(forwarded, key=str))}")
+    print("=" * 70)
+
+RESTORE_ROWS = 100000
+
+def bench_state_restore():
+    print("=" * 70)
+    print(f"SQLite state backend: write and warm-restore {RESTORE_ROWS} sessions")
+    print("=" * 70)
+
+    reset_state()
+    workdir = tempfile.mkdtemp()
+    server.STATE_BACKEND = 'sqlite'
+    server.STATE_DB_PATH = os.path.join(workdir, 'otp_state.db')
+    backend = server.init_state_backend()
+
+    now = time.time()
+    start = time.perf_counter()
+    for i in range(RESTORE_ROWS):
+        mac = f"02:00:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}"
+        server.authenticated_clients[mac] = {
+            'token': f"token-{i}",
+            'email': f"user{i}@example.com",
+            'expires': now + server.SESSION_DURATION,
+            'otp_used': f"{i % 1000000:06d}",
+            'ip': f"10.0.{i >> 8 & 0xff}.{i & 0xff}",
+            'router_status': 'authorized'
+        }
+        server.persist_entry('client', mac)
+    enqueued = time.perf_counter() - start
+    backend.queue.join()
+    written = time.perf_counter() - start
+    stats = backend.stats()
+    backend.close()
+
+    reset_state()
+    start = time.perf_counter()
+    server.init_state_backend()
+    restored = time.perf_counter() - start
+    server.state_backend.close()
+
+    print(f"enqueue on request path: {enqueued / RESTORE_ROWS * 1e6:.1f} us/row")
+    print(f"durable after:           {written:.2f} s ({stats['commits']} commits)")
+    print(f"warm restore:            {restored:.2f} s ({len(server.authenticated_clients)} sessions)")
+    print("=" * 70)
+
+    reset_state()
+    server.STATE_BACKEND = 'memory'
+    server.state_backend = server.MemoryStateBackend()
+
+TOKEN_SESSIONS = 10000
+TOKEN_CALLS = 5000
+
+def bench_session_tokens():
+    print("=" * 70)
+    print(f"check_auth: {TOKEN_CALLS} calls over {TOKEN_SESSIONS} sessions")
+    print("=" * 70)
+
+    reset_state()
+    workdir = tempfile.mkdtemp()
+    server.STATE_BACKEND = 'sqlite'
+    server.STATE_SHARED = True
+    server.STATE_DB_PATH = os.path.join(workdir, 'otp_state.db')
+    server.init_state_backend()
+
+    expires = time.time() + server.SESSION_DURATION
+    sessions = []
+    for i in range(TOKEN_SESSIONS):
+        mac = f"02:0c:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}"
+        sessions.append((mac, {
+            'token': server.issue_session_token(mac, f"user{i}@example.com", expires),
+            'email': f"user{i}@example.com",
+            'expires': expires,
+            'otp_used': None,
+            'ip': None,
+            'router_status': 'authorized'
+        }))
+    server.state_backend.save_many('client', sessions)
+    picks = [random.choice(sessions) for _ in range(TOKEN_CALLS)]
+
+    rows = []
+    for name, call in (('MAC lookup, shared SQLite', lambda mac, data: server.handle_check_auth(mac)),
+                       ('signed token', lambda mac, data: server.handle_check_auth(mac, token=data['token']))):
+        start = time.perf_counter()
+        for mac, data in picks:
+            payload, status = call(mac, data)
+            if not payload['authenticated']:
+                raise RuntimeError(f"{name}: {mac} not authenticated")
+        rows.append((name, (time.perf_counter() - start) / TOKEN_CALLS * 1e6))
+
+    print(f"{'mode':<28} {'us/call':>10}")
+    print("-" * 70)
+    for name, per_call in rows:
+        print(f"{name:<28} {per_call:>10.1f}")
+    print("=" * 70)
+
+    server.state_backend.close()
+    reset_state()
+    server.STATE_BACKEND = 'memory'
+    server.STATE_SHARED = False
+    server.state_backend = server.MemoryStateBackend()
+
+WORKER_COUNTS = [1, 4]
+WORKER_FLOWS = 400
+WORKER_CLIENTS = 32
+
+SERVER_BOOTSTRAP = """
+import sys
+import otp_auth_server as server
+server.STATE_BACKEND = 'sqlite'
+server.STATE_SHARED = True
+server.STATE_DB_PATH = sys.argv[1]
+server.SERVER_HOST = '127.0.0.1'
+server.SERVER_PORT = int(sys.argv[2])
+server.SERVER_WORKERS = int(sys.argv[3])
+server.ROUTER_AUTH_URL = sys.argv[4]
+server.run_prefork_server()
+"""
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_server(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f"{base_url}/api/stats", timeout=1)
+            return True
+        except requests.RequestException:
+            time.sleep(0.2)
+    return False
+
+def login_flow(base_url, db_path, i):
+    session = requests.Session()
+    email = f"user{i}@example.com"
+    mac = f"02:00:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}"
+
+    session.post(f"{base_url}/api/request_otp", json={'email': email, 'mac': mac}, timeout=30).raise_for_status()
+
+    # The server runs in simulation mode, so read the issued code from the shared store
+    conn = sqlite3.connect(db_path, timeout=30)
+    otp = conn.execute("SELECT otp FROM otp_requests WHERE email = ?", (email,)).fetchone()[0]
+    conn.close()
+
+    session.post(f"{base_url}/api/verify_otp", json={'otp': otp, 'mac': mac}, timeout=30).raise_for_status()
+    return session.get(f"{base_url}/api/check_auth", params={'mac': mac}, timeout=30).json()['authenticated']
+
+def bench_workers():
+    print("=" * 70)
+    print(f"Pre-fork workers over the shared SQLite store: {WORKER_FLOWS} login flows, {WORKER_CLIENTS} concurrent clients")
+    print(f"(request_otp -> verify_otp -> check_auth, {os.cpu_count()} CPU cores available)")
+    print("=" * 70)
+    print(f"{'workers':>8} {'flows/s':>10} {'failed':>8}")
+    print("-" * 70)
+
+    httpd = start_stand_in_router()
+    for workers in WORKER_COUNTS:
+        workdir = tempfile.mkdtemp()
+        db_path = os.path.join(workdir, 'otp_state.db')
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+
+        proc = subprocess.Popen(
+            [sys.executable, '-c', SERVER_BOOTSTRAP, db_path, str(port), str(workers), server.ROUTER_AUTH_URL],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        try:
+            if not wait_for_server(base_url):
+                print(f"{workers:>8} server did not start")
+                continue
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=WORKER_CLIENTS) as pool:
+                results = list(pool.map(lambda i: login_flow(base_url, db_path, i), range(WORKER_FLOWS)))
+            elapsed = time.perf_counter() - start
+
+            print(f"{workers:>8} {WORKER_FLOWS / elapsed:>10.1f} {results.count(False):>8}")
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+    httpd.shutdown()
+    print("=" * 70)
+
+ISSUE_FILL_LEVELS = [0, 100000, 500000, 900000, 990000]
+ISSUE_CALLS = 2000
+
+def legacy_issue(codes):
+    # Previous scheme: one global dictionary keyed by the code itself
+    otp = server.generate_otp()
+    while otp in codes:
+        otp = server.generate_otp()
+    codes[otp] = True
+    return otp
+
+def bench_otp_issuance():
+    print("=" * 70)
+    print(f"OTP issuance latency vs. number of pending OTPs ({server.OTP_LENGTH}-digit codes)")
+    print("=" * 70)
+    print(f"{'pending':>10} {'per-requester us':>18} {'global code dict us':>21}")
+    print("-" * 70)
+
+    entry = {'otp': '000000', 'created': time.time(), 'used': False, 'mac': None}
+    for fill in ISSUE_FILL_LEVELS:
+        reset_state()
+        server.active_otps.update((f"pending{i}@example.com", entry) for i in range(fill))
+
+        start = time.perf_counter()
+        for i in range(ISSUE_CALLS):
+            server.issue_otp(f"new{i}@example.com")
+        scoped = (time.perf_counter() - start) / ISSUE_CALLS * 1e6
+
+        codes = {}
+        while len(codes) < fill:
+            codes[server.generate_otp()] = True
+        start = time.perf_counter()
+        for i in range(ISSUE_CALLS):
+            legacy_issue(codes)
+        legacy = (time.perf_counter() - start) / ISSUE_CALLS * 1e6
+
+        print(f"{fill:>10} {scoped:>18.1f} {legacy:>21.1f}")
+
+    reset_state()
+    print("=" * 70)
+
+DERIVED_FLOOD_SIZES = [10000, 100000]
+DERIVED_VERIFY_CALLS = 2000
+
+def bench_derived_otp():
+    print("=" * 70)
+    print("OTP request flood: memory held by pending codes, stored vs. derived mode")
+    print("=" * 70)
+    print(f"{'requests':>10} {'mode':<8} {'issue us':>10} {'held KiB':>10} {'B/request':>10} {'verify us':>10}")
+    print("-" * 70)
+
+    for size in DERIVED_FLOOD_SIZES:
+        for mode in ('stored', 'derived'):
+            reset_state()
+            server.derived_otp_claims.buckets.clear()
+            server.OTP_MODE = mode
+            emails = [f"flood{i}@example.com" for i in range(size)]
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            codes = [server.issue_otp(email) for email in emails]
+            issued = (time.perf_counter() - start) / size * 1e6
+            # The returned codes are the benchmark's, not the server's
+            held = max(tracemalloc.get_traced_memory()[0] - sys.getsizeof(codes) - sum(sys.getsizeof(code) for code in codes), 0)
+            tracemalloc.stop()
+
+            start = time.perf_counter()
+            for email, otp in zip(emails[:DERIVED_VERIFY_CALLS], codes):
+                with server.state_lock:
+                    email, rejected = (server.check_derived_otp if mode == 'derived' else server.check_stored_otp)(email, otp, '02:00:00:00:00:01')
+                if rejected:
+                    raise RuntimeError(f"{mode}: code for {email} rejected: {rejected}")
+            verified = (time.perf_counter() - start) / DERIVED_VERIFY_CALLS * 1e6
+
+            print(f"{size:>10} {mode:<8} {issued:>10.1f} {held / 1024:>10.0f} {held / size:>10.0f} {verified:>10.1f}")
+
+    server.OTP_MODE = 'stored'
+    server.derived_otp_claims.buckets.clear()
+    reset_state()
+    print("=" * 70)
+
+DASHBOARD_SIZES = [1000, 10000, 100000]
+DASHBOARD_CALLS = 20
+
+def bench_dashboard():
+    print("=" * 70)
+    print("Dashboard GET / : rendered vs. cached vs. 304 Not Modified")
+    print("=" * 70)
+    print(f"{'entries':>10} {'changed ms':>12} {'cached ms':>12} {'304 ms':>12}")
+    print("-" * 70)
+
+    server.ADMIN_TOKEN = 'benchmark'
+    client = server.app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = f"Bearer {server.ADMIN_TOKEN}"
+    for size in DASHBOARD_SIZES:
+        reset_state()
+        populate(size)
+        server.mark_state_changed()
+
+        start = time.perf_counter()
+        for _ in range(DASHBOARD_CALLS):
+            server.mark_state_changed()
+            client.get('/')
+        changed = (time.perf_counter() - start) / DASHBOARD_CALLS * 1000
+
+        start = time.perf_counter()
+        for _ in range(DASHBOARD_CALLS):
+            etag = client.get('/').headers['ETag']
+        cached = (time.perf_counter() - start) / DASHBOARD_CALLS * 1000
+
+        start = time.perf_counter()
+        for _ in range(DASHBOARD_CALLS):
+            client.get('/', headers={'If-None-Match': etag})
+        not_modified = (time.perf_counter() - start) / DASHBOARD_CALLS * 1000
+
+        print(f"{size:>10} {changed:>12.2f} {cached:>12.2f} {not_modified:>12.2f}")
+
+    reset_state()
+    print("=" * 70)
+
+STATS_SIZES = [1000, 100000, 1000000]
+STATS_CALLS = 200
+SELF_CHECK_OPERATIONS = 5000
+SELF_CHECK_EMAILS = 200
+
+def bench_stats_counters():
+    print("=" * 70)
+    print("State counts for /api/stats: incremental counters vs. full scan")
+    print("=" * 70)
+    print(f"{'entries':>10} {'counters us/call':>18} {'full scan us/call':>20}")
+    print("-" * 70)
+
+    for size in STATS_SIZES:
+        reset_state()
+        populate(size)
+
+        start = time.perf_counter()
+        for _ in range(STATS_CALLS):
+            server.state_counts()
+        counted = (time.perf_counter() - start) / STATS_CALLS * 1e6
+
+        scan_calls = max(1, min(STATS_CALLS, 1000000 // size))
+        start = time.perf_counter()
+        for _ in range(scan_calls):
+            server.scan_state_counts()
+        scanned = (time.perf_counter() - start) / scan_calls * 1e6
+
+        print(f"{size:>10} {counted:>18.1f} {scanned:>20.1f}")
+
+    # Random issue / verify / reissue / expiry traffic with every count checked
+    # against a full scan
+    reset_state()
+    httpd = start_stand_in_router()
+    saved = server.OTP_VALIDITY, server.SESSION_DURATION, server.RATE_LIMIT_ENABLED
+    server.OTP_VALIDITY, server.SESSION_DURATION, server.RATE_LIMIT_ENABLED = 0.05, 0.1, False
+    server.STATS_SELF_CHECK = True
+    rng = random.Random(1)
+    try:
+        for i in range(SELF_CHECK_OPERATIONS):
+            email = f"user{rng.randrange(SELF_CHECK_EMAILS)}@example.com"
+            mac = f"02:00:00:00:{rng.randrange(256):02x}:{rng.randrange(256):02x}"
+            data = server.active_otps.get(email)
+            if data is not None and rng.random() < 0.5:
+                server.handle_verify_otp(data['otp'], mac, '10.0.10.100', email)
+            else:
+                server.handle_request_otp(email, mac, '10.0.10.100')
+            if i % 50 == 0:
+                time.sleep(0.02)
+            server.handle_stats()
+        print(f"self-check: {SELF_CHECK_OPERATIONS} operations, counters matched a full scan after each one "
+              f"({server.state_counters['expired']} expiries)")
+    finally:
+        server.STATS_SELF_CHECK = False
+        server.OTP_VALIDITY, server.SESSION_DURATION, server.RATE_LIMIT_ENABLED = saved
+        server.router_dispatcher.queue.join()
+        httpd.shutdown()
+        reset_state()
+    print("=" * 70)
+
+EMAIL_CALLS = 20000
+
+def bench_email_build():
+    print("=" * 70)
+    print("OTP email construction: per-message MIME build vs. pre-encoded template")
+    print("=" * 70)
+    print(f"{'method':>22} {'us/message':>12} {'bytes':>8}")
+    print("-" * 70)
+
+    server.email_templates.clear()
+    start = time.perf_counter()
+    server.email_template('otp')
+    print(f"{'template load (once)':>22} {(time.perf_counter() - start) * 1e6:>12.1f}")
+
+    builders = (
+        ('MIMEMultipart', lambda email, otp: server.build_otp_message(email, otp).as_bytes()),
+        ('template render', server.render_otp_email),
+    )
+    for name, build in builders:
+        start = time.perf_counter()
+        for i in range(EMAIL_CALLS):
+            message = build(f"user{i}@example.com", f"{i % 1000000:06d}")
+        elapsed = (time.perf_counter() - start) / EMAIL_CALLS * 1e6
+        print(f"{name:>22} {elapsed:>12.1f} {len(message):>8}")
+
+    print("=" * 70)
+
+BENCHMARKS = {
+    'cleanup': bench_cleanup_expired,
+    'router': bench_router_dispatch,
+    'bulk': bench_admin_bulk,
+    'agent': bench_router_agent,
+    'detect': bench_captive_detect,
+    'proxy': bench_api_proxy,
+    'restore': bench_state_restore,
+    'token': bench_session_tokens,
+    'workers': bench_workers,
+    'issue': bench_otp_issuance,
+    'derived': bench_derived_otp,
+    'dashboard': bench_dashboard,
+    'stats': bench_stats_counters,
+    'email': bench_email_build,
+}
+
+if __name__ == '__main__':
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name} (available: {', '.join(BENCHMARKS)})")
+            sys.exit(1)
+        BENCHMARKS[name]()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import time
+import email
+import argparse
+import tempfile
+import threading
+import subprocess
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmark import StandInRouter, start_stand_in_router, free_port, wait_for_server
+import otp_auth_server as server
+
+SERVER_BOOTSTRAP = """
+import sys
+import json
+import otp_auth_server as server
+
+settings = json.loads(sys.argv[1])
+for name, value in settings.items():
+    setattr(server, name, value)
+
+if settings.get('SERVER_MODE') == 'asgi':
+    import uvicorn
+    import otp_auth_asgi
+    uvicorn.run(otp_auth_asgi.app, host=server.SERVER_HOST, port=server.SERVER_PORT, log_level='warning')
+elif server.SERVER_WORKERS > 1:
+    server.run_prefork_server()
+else:
+    server.init_worker()
+    server.app.run(host=server.SERVER_HOST, port=server.SERVER_PORT, threaded=True)
+"""
+
+STAGES = ('request_otp', 'email_delivery', 'verify_otp', 'check_auth', 'flow')
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 stand-in ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply("250-stand-in")
+                self.reply("250 8BITMIME")
+            elif command.startswith('DATA'):
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for body_line in self.rfile:
+                    if body_line == b".\r\n":
+                        break
+                    data.append(body_line[1:] if body_line.startswith(b"..") else body_line)
+                time.sleep(self.server.latency)
+                if self.server.failing:
+                    self.server.reject()
+                    self.reply("451 Temporary local problem")
+                else:
+                    self.server.capture(b''.join(data))
+                    self.reply("250 OK queued")
+            elif command.startswith('QUIT'):
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+class Mailbox:
+    def __init__(self):
+        self.otps = {}
+        self.delivered = threading.Condition()
+
+    def put(self, recipient, otp):
+        with self.delivered:
+            self.otps[recipient] = otp
+            self.delivered.notify_all()
+
+    def wait_for_otp(self, recipient, timeout):
+        with self.delivered:
+            self.delivered.wait_for(lambda: recipient in self.otps, timeout)
+            return self.otps.pop(recipient, None)
+
+class StandInSMTP(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, otp_length=server.OTP_LENGTH, failing=False, mailbox=None):
+        super().__init__(('127.0.0.1', 0), StandInSMTPHandler)
+        self.latency = latency
+        self.failing = failing
+        self.mailbox = mailbox or Mailbox()
+        self.pattern = re.compile(rf"\b(\d{{{otp_length}}})\b")
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.rejected = 0
+
+    def capture(self, data):
+        message = email.message_from_bytes(data)
+        otp = None
+        for part in message.walk():
+            if part.get_content_type() == 'text/plain':
+                match = self.pattern.search(part.get_payload(decode=True).decode(errors='replace'))
+                if match:
+                    otp = match.group(1)
+                    break
+
+        with self.lock:
+            self.messages += 1
+        self.mailbox.put(message['To'], otp)
+
+    def reject(self):
+        with self.lock:
+            self.rejected += 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+def percentiles(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def rank(p):
+        return round(ordered[min(len(ordered) - 1, max(0, int(len(ordered) * p / 100 + 0.5) - 1))] * 1000, 2)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 2),
+        'p50': rank(50),
+        'p90': rank(90),
+        'p99': rank(99),
+        'max': round(ordered[-1] * 1000, 2)
+    }
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.latencies = {stage: [] for stage in STAGES}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record_error(self, stage, reason):
+        with self.lock:
+            key = f"{stage}: {reason}"
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def timed(self, stage, call):
+        start = time.perf_counter()
+        result = call()
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies[stage].append(elapsed)
+        return result
+
+    def post(self, session, stage, path, payload):
+        response = self.timed(stage, lambda: session.post(f"{self.base_url}{path}", json=payload, timeout=self.args.timeout))
+        if response.status_code != 200:
+            self.record_error(stage, f"HTTP {response.status_code}")
+            return None
+        return response.json()
+
+    def flow(self, i):
+        session = requests.Session()
+        address = f"user{i}@loadtest.example.com"
+        mac = f"02:10:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}"
+        start = time.perf_counter()
+
+        try:
+            if self.post(session, 'request_otp', '/api/request_otp', {'email': address, 'mac': mac}) is None:
+                return False
+
+            otp = self.timed('email_delivery', lambda: self.mailbox.wait_for_otp(address, self.args.timeout))
+            if otp is None:
+                self.record_error('email_delivery', 'no email received')
+                return False
+
+            verified = self.post(session, 'verify_otp', '/api/verify_otp', {'otp': otp, 'mac': mac, 'email': address})
+            if verified is None:
+                return False
+
+            response = self.timed('check_auth', lambda: session.get(
+                f"{self.base_url}/api/check_auth", params={'mac': mac, 'token': verified.get('token')}, timeout=self.args.timeout))
+            if response.status_code != 200 or not response.json().get('authenticated'):
+                self.record_error('check_auth', 'not authenticated')
+                return False
+
+        except requests.RequestException as e:
+            self.record_error('http', type(e).__name__)
+            return False
+
+        with self.lock:
+            self.latencies['flow'].append(time.perf_counter() - start)
+        return True
+
+    def settings(self, port, smtp_ports, router_url, workdir):
+        settings = {
+            'SERVER_HOST': '127.0.0.1',
+            'SERVER_PORT': port,
+            'SERVER_WORKERS': self.args.workers,
+            'SERVER_MODE': self.args.mode,
+            'EMAIL_ENABLED': True,
+            'SMTP_SERVER': '127.0.0.1',
+            'SMTP_PORT': smtp_ports[0],
+            'SMTP_USERNAME': '',
+            'SMTP_USE_TLS': False,
+            'ROUTER_AUTH_URL': router_url,
+            'RATE_LIMIT_ENABLED': self.args.rate_limit,
+            'OTP_MODE': self.args.otp_mode,
+            'LOG_LEVEL': 'ERROR'
+        }
+        if len(smtp_ports) > 1:
+            settings['SMTP_RELAYS'] = [{'host': '127.0.0.1', 'port': smtp_port} for smtp_port in smtp_ports]
+        if self.args.workers > 1 or self.args.state == 'sqlite':
+            settings.update(STATE_BACKEND='sqlite', STATE_SHARED=self.args.workers > 1,
+                            STATE_DB_PATH=os.path.join(workdir, 'otp_state.db'))
+        return settings
+
+    def run(self):
+        self.mailbox = Mailbox()
+        healthy = self.args.smtp_relays - self.args.failing_relays
+        self.relays = [StandInSMTP(self.args.smtp_latency, failing=i >= healthy, mailbox=self.mailbox).start()
+                       for i in range(self.args.smtp_relays)]
+        StandInRouter.latency = self.args.router_latency
+        router = start_stand_in_router()
+        router_url = f"http://127.0.0.1:{router.server_address[1]}/cgi-bin/auth"
+
+        workdir = tempfile.mkdtemp()
+        port = free_port()
+        self.base_url = f"http://127.0.0.1:{port}"
+        settings = self.settings(port, [relay.server_address[1] for relay in self.relays], router_url, workdir)
+
+        proc = subprocess.Popen(
+            [sys.executable, '-c', SERVER_BOOTSTRAP, json.dumps(settings)],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL if not self.args.verbose else None
+        )
+        try:
+            if not wait_for_server(self.base_url):
+                raise SystemExit("Server did not start")
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+                results = list(pool.map(self.flow, range(self.args.flows)))
+            elapsed = time.perf_counter() - start
+
+            server_stats = requests.get(f"{self.base_url}/api/stats", timeout=self.args.timeout).json()
+        finally:
+            proc.terminate()
+            proc.wait(10)
+            for relay in self.relays:
+                relay.shutdown()
+            router.shutdown()
+
+        succeeded = results.count(True)
+        return {
+            'config': {
+                'flows': self.args.flows,
+                'concurrency': self.args.concurrency,
+                'mode': self.args.mode,
+                'workers': self.args.workers,
+                'state': settings.get('STATE_BACKEND', 'memory'),
+                'otp_mode': self.args.otp_mode,
+                'smtp_latency_ms': self.args.smtp_latency * 1000,
+                'smtp_relays': self.args.smtp_relays,
+                'failing_relays': self.args.failing_relays,
+                'router_latency_ms': self.args.router_latency * 1000,
+                'rate_limit': self.args.rate_limit,
+                'cpu_count': os.cpu_count()
+            },
+            'duration_s': round(elapsed, 3),
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'error_rate': round((len(results) - succeeded) / len(results), 4) if results else 0,
+            'throughput_flows_per_s': round(succeeded / elapsed, 2) if elapsed else 0,
+            'latency_ms': {stage: percentiles(self.latencies[stage]) for stage in STAGES},
+            'errors': self.errors,
+            'stand_ins': {
+                'smtp_messages': sum(relay.messages for relay in self.relays),
+                'smtp_rejected': sum(relay.rejected for relay in self.relays),
+                'router_round_trips': StandInRouter.round_trips,
+                'router_clients': StandInRouter.clients
+            },
+            'server_stats': server_stats
+        }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Drive request_otp -> verify_otp -> check_auth flows against a local server")
+    parser.add_argument('--flows', type=int, default=500, help="number of login flows (default: 500)")
+    parser.add_argument('--concurrency', type=int, default=16, help="flows running at once (default: 16)")
+    parser.add_argument('--mode', choices=('flask', 'asgi'), default='flask', help="server mode (default: flask)")
+    parser.add_argument('--workers', type=int, default=1, help="pre-fork worker processes, flask mode only (default: 1)")
+    parser.add_argument('--state', choices=('memory', 'sqlite'), default='memory', help="state backend (default: memory)")
+    parser.add_argument('--otp-mode', choices=('stored', 'derived'), default='stored', help="OTP mode (default: stored)")
+    parser.add_argument('--smtp-latency', type=float, default=0.05, help="seconds the stand-in SMTP server takes per message (default: 0.05)")
+    parser.add_argument('--smtp-relays', type=int, default=1, help="number of stand-in SMTP relays (default: 1)")
+    parser.add_argument('--failing-relays', type=int, default=0, help="how many of the relays reject every message (default: 0)")
+    parser.add_argument('--router-latency', type=float, default=0.02, help="seconds the stand-in router takes per call (default: 0.02)")
+    parser.add_argument('--rate-limit', action='store_true', help="keep the OTP rate limiter enabled")
+    parser.add_argument('--timeout', type=float, default=30, help="per-request and email wait timeout in seconds (default: 30)")
+    parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    parser.add_argument('--verbose', action='store_true', help="show the server's stderr")
+    args = parser.parse_args()
+    if not 0 <= args.failing_relays < args.smtp_relays:
+        parser.error("--failing-relays must leave at least one working relay")
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = LoadTest(args).run()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + '\n')
+        latency = report['latency_ms']['flow'] or {}
+        print(f"{report['succeeded']}/{args.flows} flows ok, {report['throughput_flows_per_s']} flows/s, "
+              f"p50 {latency.get('p50')} ms, p99 {latency.get('p99')} ms -> {args.output}")
+    else:
+        print(output)
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import logging
+import time
+import urllib.parse
+
+import otp_auth_server as core
+
+try:
+    import aiosmtplib
+    import httpx
+    import uvicorn
+except ImportError:
+    aiosmtplib = httpx = uvicorn = None
+
+ASGI_HOST = '0.0.0.0'
+ASGI_PORT = 5000
+
+ROUTES = ('/api/request_otp', '/api/verify_otp', '/api/check_auth', '/api/stats', '/metrics')
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+    (b'access-control-allow-headers', b'Content-Type')
+]
+
+class AsyncEmailDelivery(core.EmailDeliveryQueue):
+    def __init__(self, workers, maxsize):
+        super().__init__(workers, maxsize)
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.relay_released = asyncio.Condition()
+        self.loop = None
+
+    def start(self):
+        if not self.threads:
+            self.loop = asyncio.get_running_loop()
+            self.relays = core.SmtpRelayPool(core.smtp_relay_list())
+            self.threads = [self.loop.create_task(self.run()) for _ in range(self.workers)]
+
+    def submit(self, email, otp):
+        # Handlers run in worker threads; the queue belongs to the event loop
+        if not self.accepting:
+            return False
+        if self.loop is None:
+            self.start()
+        if self.queue.full():
+            self.reject(email)
+            return False
+        self.loop.call_soon_threadsafe(self.enqueue, (email, otp, time.time()))
+        return True
+
+    def enqueue(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.reject(item[0])
+
+    def reject(self, email):
+        self.rejected += 1
+        core.log_event(logging.ERROR, 'email_queue_full', "Email queue full, dropping OTP for {email}", email=email)
+
+    async def connect(self, relay):
+        server = aiosmtplib.SMTP(hostname=relay.host, port=relay.port,
+                                 timeout=core.SMTP_TIMEOUT, start_tls=False)
+        start = time.perf_counter()
+        await server.connect()
+        core.stage_latency.observe(time.perf_counter() - start, 'smtp_connect')
+
+        if relay.use_tls:
+            start = time.perf_counter()
+            await server.starttls()
+            core.stage_latency.observe(time.perf_counter() - start, 'smtp_tls')
+
+        if relay.username:
+            start = time.perf_counter()
+            await server.login(relay.username, relay.password)
+            core.stage_latency.observe(time.perf_counter() - start, 'smtp_login')
+        return server
+
+    async def acquire(self, exclude):
+        async with self.relay_released:
+            while True:
+                relay = self.relays.try_acquire(exclude)
+                if relay is not None:
+                    return relay
+                await self.relay_released.wait()
+
+    async def release(self, relay, elapsed, failed=False):
+        self.relays.release(relay, elapsed, failed)
+        async with self.relay_released:
+            self.relay_released.notify_all()
+
+    async def run(self):
+        sessions = {}
+
+        while True:
+            try:
+                item = await asyncio.wait_for(self.queue.get(), core.EMAIL_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                for relay, server in list(sessions.items()):
+                    try:
+                        await server.noop()
+                    except Exception:
+                        server.close()
+                        del sessions[relay]
+                continue
+
+            if item is None:
+                self.queue.task_done()
+                break
+
+            email, otp, queued_at = item
+            try:
+                await self.deliver(sessions, email, otp, queued_at)
+            finally:
+                self.queue.task_done()
+
+        for server in sessions.values():
+            try:
+                await server.quit()
+            except Exception:
+                server.close()
+
+    async def send(self, server, email, otp):
+        if server.is_ehlo_or_helo_needed:
+            await server.ehlo()
+        if server.supports_extension('8bitmime'):
+            await server.sendmail(core.FROM_EMAIL, [email], core.render_otp_email(email, otp), mail_options=['BODY=8BITMIME'])
+        else:
+            await server.send_message(core.build_otp_message(email, otp))
+
+    async def deliver(self, sessions, email, otp, queued_at):
+        tried = []
+
+        for attempt in range(core.EMAIL_SEND_ATTEMPTS):
+            relay = await self.acquire(tried)
+            server = sessions.pop(relay, None)
+            attempt_start = time.perf_counter()
+            try:
+                if server is None:
+                    server = await self.connect(relay)
+                    if attempt:
+                        self.reconnects += 1
+
+                start = time.perf_counter()
+                await self.send(server, email, otp)
+                elapsed = time.perf_counter() - start
+
+            except Exception as e:
+                if server is not None:
+                    server.close()
+                await self.release(relay, time.perf_counter() - attempt_start, failed=True)
+                core.log_event(logging.WARNING, 'email_relay_failed', "Email to {email} failed on {relay}: {error}",
+                               email=email, relay=relay.name, attempt=attempt + 1, error=str(e))
+                tried.append(relay)
+                last_error = e
+                continue
+
+            await self.release(relay, time.perf_counter() - attempt_start)
+            sessions[relay] = server
+            self.record_sent(elapsed, failover=bool(attempt) and relay not in tried)
+
+            core.log_event(logging.INFO, 'email_sent', "Email sent to {email} via {relay} ({send_ms} ms, queued {queued_s}s)",
+                           email=email, relay=relay.name, send_ms=round(elapsed * 1000), queued_s=round(time.time() - queued_at, 1))
+            return
+
+        self.failed += 1
+        core.log_event(logging.ERROR, 'email_failed', "Email send failed: {error}", email=email, error=str(last_error))
+
+    async def drain(self, timeout=core.EMAIL_SHUTDOWN_TIMEOUT):
+        self.accepting = False
+        if not self.threads:
+            return
+
+        for _ in self.threads:
+            await self.queue.put(None)
+        await asyncio.wait(self.threads, timeout=timeout)
+
+class AsyncRouterDispatcher(core.RouterDispatcher):
+    def __init__(self, window, max_batch):
+        super().__init__(window, max_batch)
+        self.queue = asyncio.Queue()
+        self.client = None
+        self.loop = None
+
+    def start(self):
+        if self.thread is None:
+            self.loop = asyncio.get_running_loop()
+            limits = httpx.Limits(max_keepalive_connections=core.ROUTER_POOL_SIZE)
+            self.client = httpx.AsyncClient(timeout=core.ROUTER_TIMEOUT, limits=limits)
+            self.thread = self.loop.create_task(self.run())
+
+    def submit(self, action, mac, ip=None):
+        if self.loop is None:
+            self.start()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (action, mac, ip))
+
+    def submit_many(self, action, clients):
+        if self.loop is None:
+            self.start()
+        self.loop.call_soon_threadsafe(self.enqueue_many, action, clients)
+
+    def enqueue_many(self, action, clients):
+        for mac, ip in clients:
+            self.queue.put_nowait((action, mac, ip))
+
+    async def collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.time() + self.window
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self.collect()
+
+            for action, clients in self.group(batch).items():
+                await self.dispatch(action, clients)
+
+            for _ in batch:
+                self.queue.task_done()
+
+    async def dispatch(self, action, clients):
+        start = time.perf_counter()
+        try:
+            response = await self.client.post(
+                f"{core.ROUTER_AUTH_URL}?action={action}",
+                content=''.join(f"{mac} {ip or ''}\n" for mac, ip in clients),
+                headers={'Content-Type': 'text/plain'}
+            )
+            response.raise_for_status()
+            results = {item['mac']: item.get('status') == 'success' for item in response.json().get('results', [])}
+        except Exception as e:
+            core.log_event(logging.ERROR, 'router_batch_error', "Router {action} batch of {clients} failed: {error}",
+                           action=action, clients=len(clients), error=str(e))
+            results = {}
+
+        # Recording takes the state lock and may write to SQLite
+        await asyncio.to_thread(self.record_results, action, clients, results, time.perf_counter() - start)
+
+    async def close(self):
+        if self.thread is not None:
+            self.thread.cancel()
+            await self.client.aclose()
+
+async def neighbor_syncer(client):
+    while True:
+        try:
+            response = await client.get(core.neighbor_sync_url(), params=core.neighbor_sync_params())
+            response.raise_for_status()
+            core.neighbor_table.apply(response.json())
+        except Exception as e:
+            core.neighbor_table.record_error(e)
+        await asyncio.sleep(core.NEIGHBOR_SYNC_INTERVAL)
+
+async def expiry_reaper():
+    while True:
+        await asyncio.sleep(core.CLEANUP_INTERVAL)
+        try:
+            await asyncio.to_thread(core.reap_expired)
+        except Exception as e:
+            core.log_event(logging.ERROR, 'reaper_error', "Expiry reaper error: {error}", error=str(e))
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+def parse_params(scope, body):
+    params = {key: values[-1] for key, values in urllib.parse.parse_qs(scope['query_string'].decode()).items()}
+    if not body:
+        return params
+
+    headers = dict(scope['headers'])
+    if headers.get(b'content-type', b'').startswith(b'application/x-www-form-urlencoded'):
+        params.update({key: values[-1] for key, values in urllib.parse.parse_qs(body.decode()).items()})
+    else:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            params.update(data)
+    return params
+
+async def send_json(send, payload, status):
+    body = json.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + CORS_HEADERS
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+def route(scope, params):
+    path = scope['path']
+    method = scope['method']
+    headers = dict(scope['headers'])
+    remote_addr = scope['client'][0] if scope.get('client') else None
+    proxy_secret = headers.get(b'x-proxy-secret', b'').decode() or None
+    client_ip = core.client_address(remote_addr, headers.get(b'x-forwarded-for', b'').decode() or None, proxy_secret)
+    mac = core.forwarded_mac(remote_addr, headers.get(b'x-client-mac', b'').decode() or None, proxy_secret) or params.get('mac')
+
+    if path == '/api/request_otp' and method == 'POST':
+        return core.handle_request_otp(params.get('email'), mac, client_ip)
+    if path == '/api/verify_otp' and method in ('GET', 'POST'):
+        return core.handle_verify_otp(params.get('otp'), mac, client_ip, params.get('email'))
+    if path == '/api/check_auth' and method in ('GET', 'POST'):
+        token = params.get('token')
+        if not token and headers.get(b'authorization', b'').startswith(b'Bearer '):
+            token = headers[b'authorization'][7:].decode().strip()
+        return core.handle_check_auth(mac, client_ip, token)
+    if path == '/api/stats' and method == 'GET':
+        return core.handle_stats()
+    return {'success': False, 'error': 'Not found'}, 404
+
+async def lifespan(receive, send):
+    tasks = []
+    neighbor_client = None
+
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            core.setup_logging()
+            core.email_queue = AsyncEmailDelivery(core.EMAIL_WORKERS, core.EMAIL_QUEUE_SIZE)
+            core.router_dispatcher = AsyncRouterDispatcher(core.ROUTER_BATCH_WINDOW, core.ROUTER_BATCH_MAX)
+            core.email_queue.start()
+            core.router_dispatcher.start()
+            await asyncio.to_thread(core.init_state_backend)
+            loop = asyncio.get_running_loop()
+            tasks.append(loop.create_task(expiry_reaper()))
+            if core.NEIGHBOR_SYNC_INTERVAL:
+                neighbor_client = httpx.AsyncClient(timeout=core.ROUTER_TIMEOUT)
+                tasks.append(loop.create_task(neighbor_syncer(neighbor_client)))
+            await send({'type': 'lifespan.startup.complete'})
+
+        elif message['type'] == 'lifespan.shutdown':
+            for task in tasks:
+                task.cancel()
+            if neighbor_client is not None:
+                await neighbor_client.aclose()
+            await core.email_queue.drain()
+            await core.router_dispatcher.close()
+            core.state_backend.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    if scope['type'] != 'http':
+        return
+
+    if scope['method'] == 'OPTIONS':
+        await send({'type': 'http.response.start', 'status': 204, 'headers': CORS_HEADERS})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    start = time.perf_counter()
+    if scope['path'] == '/metrics' and scope['method'] == 'GET':
+        body = (await asyncio.to_thread(core.render_metrics)).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/plain; version=0.0.4; charset=utf-8'), (b'content-length', str(len(body)).encode())]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+        status = 200
+    else:
+        try:
+            params = parse_params(scope, await read_body(receive))
+        except UnicodeDecodeError:
+            payload, status = {'success': False, 'error': 'Request is not valid UTF-8'}, 400
+        else:
+            # The core handlers take the state lock and query SQLite, so they run
+            # in the default executor and only the network I/O stays on the loop
+            payload, status = await asyncio.to_thread(route, scope, params)
+        await send_json(send, payload, status)
+
+    path = scope['path'] if scope['path'] in ROUTES else 'unmatched'
+    core.request_latency.observe(time.perf_counter() - start, path)
+    core.request_count.inc(path, scope['method'], str(status))
+
+if __name__ == '__main__':
+    if uvicorn is None:
+        raise SystemExit("ASGI mode requires aiosmtplib, httpx and uvicorn (pip install aiosmtplib httpx uvicorn)")
+
+    print("=" * 70)
+    print("🔐 OTP Authentication Server (ASGI / asyncio mode)")
+    print("=" * 70)
+    print(f"Server starting on http://{ASGI_HOST}:{ASGI_PORT}")
+    print(f"  - Email Sending: {'ENABLED (Real emails)' if core.EMAIL_ENABLED else 'SIMULATION MODE (Console only)'}")
+    print(f"  - State Backend: {core.STATE_BACKEND}")
+    print("=" * 70)
+
+    uvicorn.run(app, host=ASGI_HOST, port=ASGI_PORT, log_level='warning')
@@ -1,28 +1,70 @@
 #!/usr/bin/env python3
 
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify, url_for, g
 from flask_cors import CORS
 import secrets
+import random
+import hashlib
+import hmac
+import base64
+import os
 import time
+import heapq
+import bisect
+import threading
+import queue
+import atexit
+import itertools
+import logging
+import logging.handlers
+import sys
 import json
+import sqlite3
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.header import Header
 from datetime import datetime, timedelta
 import re
+import io
+import csv
 import requests
 import urllib.parse
+from collections import OrderedDict
 
 app = Flask(__name__)
 CORS(app)
 
 active_otps = {}
+otp_requests_by_mac = {}
 authenticated_clients = {}
 pending_registrations = {}
 
+state_lock = threading.RLock()
+expiry_heap = []
+state_version = 0
+state_counters = {'used_otps': 0, 'issued': 0, 'verified': 0, 'expired': 0}
+
+# Used when SESSION_TOKEN_KEYS is empty; pre-fork workers inherit it, separate instances do not
+session_token_fallback_key = secrets.token_bytes(32)
+otp_fallback_secret = secrets.token_bytes(32)
+
 OTP_LENGTH = 6
 OTP_VALIDITY = 300
+OTP_MODE = 'stored'
+OTP_SECRET = None
+OTP_STEP = 60
 SESSION_DURATION = 3600
+SESSION_TOKEN_KEYS = {}
+SESSION_TOKEN_KEY_ID = None
+CLEANUP_INTERVAL = 5
+
+STATE_BACKEND = 'memory'
+STATE_DB_PATH = 'otp_state.db'
+STATE_SHARED = False
+STATE_FLUSH_INTERVAL = 0.05
+STATE_FLUSH_BATCH = 1000
+STATS_SELF_CHECK = False
 
 EMAIL_ENABLED = False
 SMTP_SERVER = "smtp.example.com"
@@ -30,575 +72,2731 @@ SMTP_PORT = 587
 SMTP_USERNAME = "your-email@example.com"
 SMTP_PASSWORD = "your-password-here"
 FROM_EMAIL = "your-email@example.com"
+SMTP_USE_TLS = True
+SMTP_TIMEOUT = 10
+SMTP_RELAYS = []
+SMTP_RELAY_MAX_ERROR_RATE = 0.5
+SMTP_RELAY_MAX_LATENCY = 5
+SMTP_RELAY_COOLDOWN = 30
+SMTP_RELAY_DECAY = 0.2
+
+EMAIL_WORKERS = 4
+EMAIL_QUEUE_SIZE = 1000
+EMAIL_KEEPALIVE_INTERVAL = 60
+EMAIL_SEND_ATTEMPTS = 2
+EMAIL_SHUTDOWN_TIMEOUT = 30
+EMAIL_TEMPLATE_DIR = 'email_templates'
+EMAIL_LOCALE = 'en'
+
+ROUTER_AUTH_URL = "http://192.168.1.1:8081/auth"
+ROUTER_TIMEOUT = 5
+ROUTER_POOL_SIZE = 4
+ROUTER_BATCH_WINDOW = 0.05
+ROUTER_BATCH_MAX = 200
+
+NEIGHBOR_SYNC_URL = None
+NEIGHBOR_SYNC_INTERVAL = 2
+NEIGHBOR_MAX_AGE = 30
+TRUSTED_PROXIES = None
+PROXY_SECRET = None
+
+RATE_LIMIT_ENABLED = True
+RATE_LIMITS = {
+    'email': (3, 300),
+    'ip': (120, 60),
+    'mac': (5, 300)
+}
+RATE_LIMIT_MAX_KEYS = 100000
+
+ADMIN_PAGE_SIZE = 100
+ADMIN_PAGE_MAX = 1000
+ADMIN_BULK_MAX = 20000
+ADMIN_BULK_TIMEOUT = 60
+ADMIN_TOKEN = None
+EVENT_QUEUE_SIZE = 1000
+EVENT_HEARTBEAT_INTERVAL = 15
+STATIC_MAX_AGE = 31536000
+
+LOG_LEVEL = 'INFO'
+LOG_FILE = None
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_QUEUE_SIZE = 10000
+LOG_SAMPLE_EVERY = {
+    'otp_invalid': 10,
+    'otp_rate_limited': 10
+}
+
+METRICS_STRIPES = 16
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+SERVER_HOST = '0.0.0.0'
+SERVER_PORT = 5000
+SERVER_WORKERS = 1
+SERVER_THREADS = 8
+
+logger = logging.getLogger('otp_auth')
+logger.propagate = False
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+log_listener = None
+log_lock = threading.Lock()
+log_dropped = 0
+log_sample_counters = {event: itertools.count() for event in LOG_SAMPLE_EVERY}
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        fields = getattr(record, 'fields', None)
+        if fields is None:
+            message = record.getMessage()
+            fields = {}
+        else:
+            message = record.msg.format(**fields)
+
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'event': getattr(record, 'event', None),
+            'message': message,
+            'pid': record.process,
+            'thread': record.threadName
+        }
+        entry.update(fields)
+        return json.dumps(entry, default=str)
+
+class StructuredLogListener(logging.handlers.QueueListener):
+    # Request threads only queue a tuple; the LogRecord is built, formatted and
+    # written here on the listener thread
+    def prepare(self, item):
+        level, event, message, fields, created, thread_name = item
+        record = logger.makeRecord(logger.name, level, '', 0, message, None, None,
+                                   extra={'event': event, 'fields': fields})
+        record.created = created
+        record.threadName = thread_name
+        return record
+
+def setup_logging():
+    global log_listener
+    with log_lock:
+        if log_listener is not None:
+            return
+
+        if LOG_FILE:
+            handler = logging.handlers.RotatingFileHandler(
+                LOG_FILE.format(pid=os.getpid()),
+                maxBytes=LOG_MAX_BYTES,
+                backupCount=LOG_BACKUP_COUNT,
+                encoding='utf-8'
+            )
+        else:
+            handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonLogFormatter())
+
+        logger.setLevel(LOG_LEVEL)
+        log_listener = StructuredLogListener(log_queue, handler)
+        log_listener.start()
+        atexit.register(stop_logging)
+
+def stop_logging():
+    global log_listener
+    with log_lock:
+        if log_listener is not None:
+            log_listener.stop()
+            log_listener = None
+
+def log_event(level, event, message, **fields):
+    global log_dropped
+    if log_listener is None:
+        setup_logging()
+    if not logger.isEnabledFor(level):
+        return
+
+    counter = log_sample_counters.get(event)
+    if counter is not None:
+        every = LOG_SAMPLE_EVERY[event]
+        if next(counter) % every:
+            return
+        fields['sample_rate'] = every
+
+    try:
+        log_queue.put_nowait((level, event, message, fields, time.time(), threading.current_thread().name))
+    except queue.Full:
+        with log_lock:
+            log_dropped += 1
+
+def log_stats():
+    return {
+        'level': LOG_LEVEL,
+        'queue_depth': log_queue.qsize(),
+        'dropped': log_dropped
+    }
 
-ROUTER_AUTH_URL = "http://192.168.1.1/cgi-bin/auth"
+metrics_registry = []
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        # Each thread updates one of several independently locked stripes, so
+        # request threads rarely wait on each other; stripes are summed on scrape
+        self.stripes = [({}, threading.Lock()) for _ in range(METRICS_STRIPES)]
+        metrics_registry.append(self)
+
+    def stripe(self):
+        return self.stripes[threading.get_native_id() % METRICS_STRIPES]
+
+    def header(self):
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        values, lock = self.stripe()
+        with lock:
+            values[labels] = values.get(labels, 0) + amount
+
+    def render(self):
+        totals = {}
+        for values, lock in self.stripes:
+            with lock:
+                for labels, value in values.items():
+                    totals[labels] = totals.get(labels, 0) + value
+
+        lines = self.header()
+        for labels, value in sorted(totals.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        values, lock = self.stripe()
+        with lock:
+            counts = values.get(labels)
+            if counts is None:
+                counts = values[labels] = [0] * (len(self.buckets) + 3)
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        totals = {}
+        for values, lock in self.stripes:
+            with lock:
+                for labels, counts in values.items():
+                    merged = totals.setdefault(labels, [0] * len(counts))
+                    for i, count in enumerate(counts):
+                        merged[i] += count
+
+        lines = self.header()
+        names = self.labelnames + ('le',)
+        for labels, counts in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {counts[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {counts[-1]}")
+        return lines
+
+class CallbackMetric(Metric):
+    def __init__(self, name, description, kind, callback, labelnames=()):
+        super().__init__(name, description, labelnames)
+        self.kind = kind
+        self.callback = callback
+
+    def render(self):
+        value = self.callback()
+        if not isinstance(value, dict):
+            value = {(): value}
+
+        lines = self.header()
+        for labels, number in sorted(value.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {number}")
+        return lines
+
+request_count = Counter('otp_http_requests_total', 'HTTP requests by route, method and status', ('route', 'method', 'status'))
+request_latency = Histogram('otp_http_request_duration_seconds', 'HTTP request latency by route', ('route',))
+stage_latency = Histogram('otp_stage_duration_seconds', 'Latency of individual login stages', ('stage',))
+
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
 
 def validate_email(email):
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
     return re.match(pattern, email) is not None
 
+def normalize_mac(mac):
+    mac = str(mac or '').strip().lower().replace('-', ':')
+    pattern = r'^[0-9a-f]{2}(:[0-9a-f]{2}){5}$'
+    return mac if re.match(pattern, mac) else None
+
+def valid_otp_code(otp):
+    # Client input: anything but OTP_LENGTH ASCII digits is wrong before any comparison
+    return isinstance(otp, str) and len(otp) == OTP_LENGTH and otp.isascii() and otp.isdigit()
+
 def generate_otp():
-    return ''.join([str(secrets.randbelow(10)) for _ in range(OTP_LENGTH)])
+    start = time.perf_counter()
+    otp = ''.join([str(secrets.randbelow(10)) for _ in range(OTP_LENGTH)])
+    stage_latency.observe(time.perf_counter() - start, 'generate_otp')
+    return otp
+
+def otp_window():
+    return -(-OTP_VALIDITY // OTP_STEP)
+
+def derive_otp(email, step):
+    # HOTP dynamic truncation of HMAC-SHA256(secret, "email|step")
+    secret = OTP_SECRET or otp_fallback_secret
+    digest = hmac.new(secret.encode() if isinstance(secret, str) else secret, f"{email}|{step}".encode(), hashlib.sha256).digest()
+    offset = digest[-1] & 0x0f
+    value = int.from_bytes(digest[offset:offset + 4], 'big') & 0x7fffffff
+    return str(value % 10 ** OTP_LENGTH).zfill(OTP_LENGTH)
+
+def match_derived_otp(email, otp, now=None):
+    if not valid_otp_code(otp):
+        return None
+    current = int((now or time.time()) // OTP_STEP)
+    for step in range(current, current - otp_window() - 1, -1):
+        if hmac.compare_digest(derive_otp(email, step), otp):
+            return step
+    return None
+
+class DerivedOtpClaims:
+    # Claimed time steps per email digest, bucketed by step: a claim blocks
+    # every code of its step or earlier, and whole buckets are dropped once
+    # none of the codes they block can still be valid
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def claim(self, key, step, current):
+        with self.lock:
+            for old in [bucket for bucket in self.buckets if bucket < current - otp_window()]:
+                del self.buckets[old]
+            if any(key in keys for bucket, keys in self.buckets.items() if bucket >= step):
+                return False
+            self.buckets.setdefault(step, set()).add(key)
+            return True
 
-def send_email_otp(email, otp):
-    if not EMAIL_ENABLED:
-        print(f"[EMAIL SIMULATION] Would send OTP {otp} to {email}")
-        print(f"[EMAIL SIMULATION] Subject: Your WiFi Access Code")
-        print(f"[EMAIL SIMULATION] Body: Your OTP is: {otp} (valid for 5 minutes)")
-        return True
+    def load(self, claims):
+        with self.lock:
+            for key, step in claims:
+                self.buckets.setdefault(step, set()).add(key)
 
-    try:
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = 'Your WiFi Access Code'
-        msg['From'] = FROM_EMAIL
-        msg['To'] = email
-
-        html = f"""
-        <html>
-        <body style="font-family: Arial, sans-serif; padding: 20px; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);">
-            <div style="max-width: 600px; margin: 0 auto; background: white; padding: 40px; border-radius: 20px; box-shadow: 0 8px 30px rgba(0,0,0,0.2);">
-                <h2 style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); -webkit-background-clip: text; -webkit-text-fill-color: transparent; text-align: center; font-size: 28px; margin-bottom: 20px;">🔐 WiFi Access Code</h2>
-                <p style="font-size: 16px; color: #333;">Hello,</p>
-                <p style="font-size: 16px; color: #333;">Your One-Time Password (OTP) for WiFi access is:</p>
-                <div style="background: linear-gradient(135deg, #f0f4ff 0%, #e8f5e9 100%); padding: 30px; border-radius: 15px; text-align: center; margin: 25px 0; border: 3px solid #38ef7d;">
-                    <h1 style="color: #38ef7d; font-size: 48px; letter-spacing: 15px; margin: 0; text-shadow: 0 0 10px rgba(56, 239, 125, 0.3);">{otp}</h1>
-                </div>
-                <p style="font-size: 14px; color: #666;">This code is valid for <strong>5 minutes</strong>.</p>
-                <p style="font-size: 14px; color: #666;">Enter this code on the WiFi login page to connect to the internet.</p>
-                <hr style="border: none; border-top: 1px solid #ddd; margin: 30px 0;">
-                <p style="font-size: 12px; color: #999; text-align: center;">
-                    If you didn't request this code, please ignore this email.
-                </p>
-            </div>
-        </body>
-        </html>
-        """
+    def __len__(self):
+        with self.lock:
+            return sum(len(keys) for keys in self.buckets.values())
 
-        text = f"""
-        WiFi Access Code
+derived_otp_claims = DerivedOtpClaims()
 
-        Your One-Time Password (OTP) is: {otp}
+def claim_derived_otp(email, step):
+    key = hashlib.blake2b(email.encode(), digest_size=8).hexdigest()
+    expires_at = (step + otp_window() + 1) * OTP_STEP
+    if STATE_SHARED:
+        return state_backend.claim_otp_step(key, step, expires_at)
 
-        This code is valid for 5 minutes.
-        Enter this code on the WiFi login page to connect to the internet.
+    if not derived_otp_claims.claim(key, step, int(time.time() // OTP_STEP)):
+        return False
+    state_backend.save_otp_claim(key, step, expires_at)
+    return True
 
-        If you didn't request this code, please ignore this email.
-        """
+def session_token_keys():
+    if SESSION_TOKEN_KEYS:
+        return SESSION_TOKEN_KEYS, SESSION_TOKEN_KEY_ID or next(iter(SESSION_TOKEN_KEYS))
+    return {'local': session_token_fallback_key}, 'local'
 
-        part1 = MIMEText(text, 'plain')
-        part2 = MIMEText(html, 'html')
-        msg.attach(part1)
-        msg.attach(part2)
+def token_b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
 
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SMTP_USERNAME, SMTP_PASSWORD)
-            server.send_message(msg)
+def token_hmac(key, message):
+    return hmac.new(key.encode() if isinstance(key, str) else key, message.encode(), hashlib.sha256).digest()
 
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Email sent to {email}")
-        return True
+def issue_session_token(mac, email, expires):
+    # <kid>.<base64 "mac|email hash|expiry">.<HMAC-SHA256 of the first two parts>
+    keys, kid = session_token_keys()
+    email_hash = token_hmac(keys[kid], email or '').hex()[:16]
+    payload = token_b64(f"{mac.lower()}|{email_hash}|{int(expires)}".encode())
+    return f"{kid}.{payload}.{token_b64(token_hmac(keys[kid], f'{kid}.{payload}'))}"
 
-    except Exception as e:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Email send failed: {str(e)}")
-        return False
+def verify_session_token(token, mac=None):
+    try:
+        kid, payload, signature = token.split('.')
+    except (AttributeError, ValueError):
+        return None
 
-def authenticate_on_router(mac_address, ip_address=None):
+    key = session_token_keys()[0].get(kid)
+    if key is None or not hmac.compare_digest(token_b64(token_hmac(key, f'{kid}.{payload}')), signature):
+        return None
     try:
-        mac_encoded = urllib.parse.quote(mac_address)
-        ip_param = f"&ip={urllib.parse.quote(ip_address)}" if ip_address else ""
+        token_mac, email_hash, expires = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode().split('|')
+        expires = int(expires)
+    except ValueError:
+        return None
+
+    if expires <= time.time() or (mac and mac.lower() != token_mac):
+        return None
+    return {'mac': token_mac, 'email_hash': email_hash, 'expires': expires, 'kid': kid}
+
+class RateLimiter:
+    def __init__(self, limits, max_keys):
+        self.limits = limits
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.allowed = 0
+        self.evicted = 0
+        self.shed = {kind: 0 for kind in limits}
+
+    def refill(self, kind, key, now):
+        capacity, period = self.limits[kind]
+        bucket = self.buckets.get((kind, key))
+        if bucket is None:
+            return capacity
+        tokens, updated = bucket
+        return min(capacity, tokens + (now - updated) * capacity / period)
+
+    def allow(self, keys):
+        now = time.monotonic()
+        keys = [(kind, key) for kind, key in keys if key and kind in self.limits]
+
+        with self.lock:
+            tokens = [self.refill(kind, key, now) for kind, key in keys]
+
+            for (kind, key), available in zip(keys, tokens):
+                if available < 1:
+                    self.shed[kind] += 1
+                    capacity, period = self.limits[kind]
+                    return False, kind, int((1 - available) * period / capacity) + 1
+
+            # Only charge the buckets once every key has a token, so a request shed by
+            # one limit does not eat into the others
+            for (kind, key), available in zip(keys, tokens):
+                self.buckets[(kind, key)] = (available - 1, now)
+                self.buckets.move_to_end((kind, key))
+
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+                self.evicted += 1
+
+            self.allowed += 1
+            return True, None, 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': RATE_LIMIT_ENABLED,
+                'allowed': self.allowed,
+                'shed': dict(self.shed),
+                'shed_total': sum(self.shed.values()),
+                'tracked_keys': len(self.buckets),
+                'evicted': self.evicted
+            }
 
-        url = f"{ROUTER_AUTH_URL}?action=auth&mac={mac_encoded}{ip_param}"
+rate_limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_MAX_KEYS)
 
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔓 Authenticating {mac_address} on router...")
+def send_email_otp(email, otp):
+    start = time.perf_counter()
+    if not EMAIL_ENABLED:
+        log_event(logging.INFO, 'email_simulated', "[EMAIL SIMULATION] Would send OTP {otp} to {email}", otp=otp, email=email)
+        submitted = True
+    else:
+        submitted = email_queue.submit(email, otp)
+
+    stage_latency.observe(time.perf_counter() - start, 'send_email_otp')
+    return submitted
+
+class EmailTemplate:
+    FIELD = re.compile(rb'\{\{(\w+)\}\}')
+
+    def __init__(self, name, locale):
+        directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), EMAIL_TEMPLATE_DIR, name, locale)
+        fixed = {'validity_minutes': str(OTP_VALIDITY // 60)}
+
+        def load(filename):
+            with open(os.path.join(directory, filename), encoding='utf-8') as template_file:
+                text = template_file.read()
+            for field, value in fixed.items():
+                text = text.replace(f"{{{{{field}}}}}", value)
+            return text
+
+        self.subject = load('subject.txt').strip()
+        self.text = load('body.txt')
+        self.html = load('body.html')
+
+        boundary = f"==otp_{secrets.token_hex(12)}=="
+        subject = self.subject if self.subject.isascii() else Header(self.subject, 'utf-8').encode()
+        skeleton = (
+            f'Content-Type: multipart/alternative; boundary="{boundary}"\n'
+            "MIME-Version: 1.0\n"
+            f"Subject: {subject}\n"
+            f"From: {FROM_EMAIL}\n"
+            "To: {{recipient}}\n"
+            "\n"
+            f"--{boundary}\n"
+            'Content-Type: text/plain; charset="utf-8"\n'
+            "Content-Transfer-Encoding: 8bit\n"
+            "\n"
+            f"{self.text}\n"
+            f"--{boundary}\n"
+            'Content-Type: text/html; charset="utf-8"\n'
+            "Content-Transfer-Encoding: 8bit\n"
+            "\n"
+            f"{self.html}\n"
+            f"--{boundary}--\n"
+        )
+        self.chunks = self.FIELD.split(skeleton.replace('\n', '\r\n').encode('utf-8'))
+        self.fields = [name.decode() for name in self.chunks[1::2]]
+
+    def render(self, **fields):
+        chunks = self.chunks[:]
+        chunks[1::2] = [fields[name].encode('utf-8') for name in self.fields]
+        return b''.join(chunks)
+
+email_templates = {}
+
+def email_template(name, locale=None):
+    key = (name, locale or EMAIL_LOCALE)
+    template = email_templates.get(key)
+    if template is None:
+        template = email_templates[key] = EmailTemplate(*key)
+    return template
+
+def render_otp_email(email, otp):
+    return email_template('otp').render(recipient=email, otp=otp)
+
+def build_otp_message(email, otp):
+    template = email_template('otp')
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = template.subject
+    msg['From'] = FROM_EMAIL
+    msg['To'] = email
+
+    msg.attach(MIMEText(template.text.replace('{{otp}}', otp), 'plain'))
+    msg.attach(MIMEText(template.html.replace('{{otp}}', otp), 'html'))
+    return msg
+
+def send_otp_email(server, email, otp):
+    server.ehlo_or_helo_if_needed()
+    if server.has_extn('8bitmime'):
+        server.sendmail(FROM_EMAIL, [email], render_otp_email(email, otp), mail_options=['BODY=8BITMIME'])
+    else:
+        server.send_message(build_otp_message(email, otp))
+
+class SmtpRelay:
+    def __init__(self, host, port=587, username=None, password=None, use_tls=None, weight=1, max_connections=None):
+        self.name = f"{host}:{port}"
+        self.host = host
+        self.port = port
+        self.username = SMTP_USERNAME if username is None else username
+        self.password = SMTP_PASSWORD if password is None else password
+        self.use_tls = SMTP_USE_TLS if use_tls is None else use_tls
+        self.weight = weight
+        self.max_connections = max_connections or EMAIL_WORKERS
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.ejections = 0
+        self.error_rate = 0.0
+        self.latency = None
+        self.down_until = 0
+
+    def record(self, elapsed, failed, now):
+        if failed:
+            self.failed += 1
+        else:
+            self.sent += 1
+
+        # Health restarts from scratch when a relay comes back from cooldown;
+        # sends that finish while it is out do not count
+        if self.down_until > now:
+            return
+        self.error_rate += SMTP_RELAY_DECAY * (failed - self.error_rate)
+        if not failed:
+            self.latency = elapsed if self.latency is None else self.latency + SMTP_RELAY_DECAY * (elapsed - self.latency)
+
+        if self.error_rate >= SMTP_RELAY_MAX_ERROR_RATE or (self.latency or 0) >= SMTP_RELAY_MAX_LATENCY:
+            log_event(logging.WARNING, 'smtp_relay_down', "SMTP relay {relay} taken out for {cooldown}s "
+                      "(error rate {error_rate}, latency {latency_ms} ms)", relay=self.name, cooldown=SMTP_RELAY_COOLDOWN,
+                      error_rate=round(self.error_rate, 2), latency_ms=round((self.latency or 0) * 1000))
+            self.down_until = now + SMTP_RELAY_COOLDOWN
+            self.ejections += 1
+            self.error_rate = 0.0
+            self.latency = None
+
+    def stats(self, now):
+        return {
+            'relay': self.name,
+            'weight': self.weight,
+            'healthy': self.down_until <= now,
+            'in_flight': self.in_flight,
+            'max_connections': self.max_connections,
+            'sent': self.sent,
+            'failed': self.failed,
+            'ejections': self.ejections,
+            'error_rate': round(self.error_rate, 3),
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None
+        }
 
-        response = requests.get(url, timeout=5)
+def smtp_relay_list():
+    if not SMTP_RELAYS:
+        return [SmtpRelay(SMTP_SERVER, SMTP_PORT)]
+    return [SmtpRelay(**relay) for relay in SMTP_RELAYS]
+
+class SmtpRelayPool:
+    def __init__(self, relays):
+        self.relays = relays
+        self.condition = threading.Condition()
+
+    def choose(self, exclude):
+        # Relays already tried for this message are skipped while others
+        # remain; relays in cooldown are skipped unless all of them are down
+        now = time.time()
+        relays = [relay for relay in self.relays if relay not in exclude] or self.relays
+        up = [relay for relay in relays if relay.down_until <= now] or [min(relays, key=lambda relay: relay.down_until)]
+        available = [relay for relay in up if relay.in_flight < relay.max_connections]
+        if not available:
+            return None
+
+        weights = [relay.weight * (1 - relay.error_rate) + 1e-6 for relay in available]
+        relay = random.choices(available, weights)[0]
+        relay.in_flight += 1
+        return relay
+
+    def try_acquire(self, exclude=()):
+        with self.condition:
+            return self.choose(exclude)
+
+    def acquire(self, exclude=()):
+        with self.condition:
+            while True:
+                relay = self.choose(exclude)
+                if relay is not None:
+                    return relay
+                self.condition.wait()
+
+    def release(self, relay, elapsed, failed=False):
+        with self.condition:
+            relay.in_flight -= 1
+            relay.record(elapsed, failed, time.time())
+            self.condition.notify_all()
+
+    def stats(self):
+        now = time.time()
+        with self.condition:
+            return [relay.stats(now) for relay in self.relays]
+
+def smtp_connect(relay):
+    start = time.perf_counter()
+    server = smtplib.SMTP(relay.host, relay.port, timeout=SMTP_TIMEOUT)
+    stage_latency.observe(time.perf_counter() - start, 'smtp_connect')
+
+    if relay.use_tls:
+        start = time.perf_counter()
+        server.starttls()
+        stage_latency.observe(time.perf_counter() - start, 'smtp_tls')
+
+    if relay.username:
+        start = time.perf_counter()
+        server.login(relay.username, relay.password)
+        stage_latency.observe(time.perf_counter() - start, 'smtp_login')
+    return server
+
+def smtp_close(server):
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+class EmailDeliveryQueue:
+    def __init__(self, workers, maxsize):
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.accepting = True
+        self.sent = 0
+        self.failed = 0
+        self.rejected = 0
+        self.reconnects = 0
+        self.failovers = 0
+        self.relays = None
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            self.relays = SmtpRelayPool(smtp_relay_list())
+            for i in range(self.workers):
+                worker = threading.Thread(target=self.run, name=f'email-worker-{i}', daemon=True)
+                worker.start()
+                self.threads.append(worker)
+
+    def submit(self, email, otp):
+        if not self.accepting:
+            return False
 
-        if response.status_code == 200:
-            result = response.json()
-            if result.get('status') == 'success':
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Router auth successful: {mac_address}")
-                return True
-            else:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Router auth failed: {result.get('message')}")
-                return False
-        else:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Router auth HTTP error: {response.status_code}")
+        self.start()
+        try:
+            self.queue.put_nowait((email, otp, time.time()))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            log_event(logging.ERROR, 'email_queue_full', "Email queue full, dropping OTP for {email}", email=email)
             return False
 
-    except Exception as e:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Router auth exception: {str(e)}")
+    def run(self):
+        sessions = {}
+
+        while True:
+            try:
+                item = self.queue.get(timeout=EMAIL_KEEPALIVE_INTERVAL)
+            except queue.Empty:
+                self.keepalive(sessions)
+                continue
+
+            if item is None:
+                self.queue.task_done()
+                break
+
+            email, otp, queued_at = item
+            try:
+                self.deliver(sessions, email, otp, queued_at)
+            finally:
+                self.queue.task_done()
+
+        for server in sessions.values():
+            smtp_close(server)
+
+    def keepalive(self, sessions):
+        for relay, server in list(sessions.items()):
+            try:
+                server.noop()
+            except Exception:
+                server.close()
+                del sessions[relay]
+
+    def deliver(self, sessions, email, otp, queued_at):
+        tried = []
+
+        for attempt in range(EMAIL_SEND_ATTEMPTS):
+            relay = self.relays.acquire(tried)
+            server = sessions.pop(relay, None)
+            attempt_start = time.perf_counter()
+            try:
+                if server is None:
+                    server = smtp_connect(relay)
+                    if attempt:
+                        with self.lock:
+                            self.reconnects += 1
+
+                start = time.perf_counter()
+                send_otp_email(server, email, otp)
+                elapsed = time.perf_counter() - start
+
+            except Exception as e:
+                if server is not None:
+                    server.close()
+                self.relays.release(relay, time.perf_counter() - attempt_start, failed=True)
+                log_event(logging.WARNING, 'email_relay_failed', "Email to {email} failed on {relay}: {error}",
+                          email=email, relay=relay.name, attempt=attempt + 1, error=str(e))
+                tried.append(relay)
+                last_error = e
+                continue
+
+            self.relays.release(relay, time.perf_counter() - attempt_start)
+            sessions[relay] = server
+            self.record_sent(elapsed, failover=bool(attempt) and relay not in tried)
+
+            log_event(logging.INFO, 'email_sent', "Email sent to {email} via {relay} ({send_ms} ms, queued {queued_s}s)",
+                      email=email, relay=relay.name, send_ms=round(elapsed * 1000), queued_s=round(time.time() - queued_at, 1))
+            return
+
+        with self.lock:
+            self.failed += 1
+        log_event(logging.ERROR, 'email_failed', "Email send failed: {error}", email=email, error=str(last_error))
+
+    def record_sent(self, elapsed, failover=False):
+        stage_latency.observe(elapsed, 'smtp_send')
+        with self.lock:
+            self.sent += 1
+            self.failovers += failover
+            self.latency_total += elapsed
+            self.latency_last = elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+
+    def shutdown(self, timeout=EMAIL_SHUTDOWN_TIMEOUT):
+        self.accepting = False
+        if not self.threads:
+            return
+
+        for _ in self.threads:
+            self.queue.put(None)
+
+        deadline = time.time() + timeout
+        for worker in self.threads:
+            worker.join(max(0, deadline - time.time()))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'workers': len(self.threads),
+                'sent': self.sent,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'reconnects': self.reconnects,
+                'failovers': self.failovers,
+                'avg_send_ms': round(self.latency_total / self.sent * 1000, 1) if self.sent else 0,
+                'max_send_ms': round(self.latency_max * 1000, 1),
+                'last_send_ms': round(self.latency_last * 1000, 1),
+                'relays': self.relays.stats() if self.relays else []
+            }
+
+email_queue = EmailDeliveryQueue(EMAIL_WORKERS, EMAIL_QUEUE_SIZE)
+atexit.register(email_queue.shutdown)
+
+def create_router_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=ROUTER_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+router_session = create_router_session()
+
+def router_batch(action, clients, timeout=None):
+    body = ''.join(f"{mac} {ip or ''}\n" for mac, ip in clients)
+    response = router_session.post(
+        f"{ROUTER_AUTH_URL}?action={action}",
+        data=body,
+        headers={'Content-Type': 'text/plain'},
+        timeout=timeout or ROUTER_TIMEOUT
+    )
+    response.raise_for_status()
+    result = response.json()
+    return {item['mac']: item.get('status') == 'success' for item in result.get('results', [])}
+
+class NeighborTable:
+    def __init__(self):
+        self.entries = {}
+        self.boot = None
+        self.version = 0
+        self.synced = 0
+        self.syncs = 0
+        self.full_syncs = 0
+        self.errors = 0
+        self.failing = False
+        self.lock = threading.Lock()
+
+    def apply(self, update):
+        entries, removed = update['set'], update['remove']
+        with self.lock:
+            if update['full']:
+                self.entries = dict(entries)
+                self.full_syncs += 1
+            else:
+                self.entries.update(entries)
+                for ip in removed:
+                    self.entries.pop(ip, None)
+            self.boot = update['boot']
+            self.version = update['version']
+            self.synced = time.time()
+            self.syncs += 1
+            recovered, self.failing = self.failing, False
+
+        if recovered:
+            log_event(logging.INFO, 'neighbor_sync_restored', "Neighbor table sync restored ({entries} entries)", entries=len(self.entries))
+
+    def record_error(self, error):
+        with self.lock:
+            self.errors += 1
+            first, self.failing = not self.failing, True
+
+        if first:
+            log_event(logging.WARNING, 'neighbor_sync_failed', "Neighbor table sync failed: {error}", error=str(error))
+
+    def resolve(self, ip):
+        if not ip or time.time() - self.synced > NEIGHBOR_MAX_AGE:
+            return None
+        return self.entries.get(ip)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'version': self.version,
+                'age_s': round(time.time() - self.synced, 1) if self.synced else None,
+                'syncs': self.syncs,
+                'full_syncs': self.full_syncs,
+                'errors': self.errors
+            }
+
+neighbor_table = NeighborTable()
+
+def neighbor_sync_url():
+    if NEIGHBOR_SYNC_URL:
+        return NEIGHBOR_SYNC_URL
+    parts = urllib.parse.urlsplit(ROUTER_AUTH_URL)
+    return f"{parts.scheme}://{parts.netloc}/neighbors"
+
+def neighbor_sync_params():
+    return {'since': neighbor_table.version, 'boot': neighbor_table.boot or ''}
+
+def neighbor_syncer():
+    while True:
+        try:
+            response = router_session.get(neighbor_sync_url(), params=neighbor_sync_params(), timeout=ROUTER_TIMEOUT)
+            response.raise_for_status()
+            neighbor_table.apply(response.json())
+        except Exception as e:
+            neighbor_table.record_error(e)
+        time.sleep(NEIGHBOR_SYNC_INTERVAL)
+
+def start_neighbor_sync():
+    if not NEIGHBOR_SYNC_INTERVAL:
+        return None
+    syncer = threading.Thread(target=neighbor_syncer, name='neighbor-sync', daemon=True)
+    syncer.start()
+    return syncer
+
+def proxy_addresses():
+    return TRUSTED_PROXIES if TRUSTED_PROXIES is not None else (urllib.parse.urlsplit(ROUTER_AUTH_URL).hostname,)
+
+def trusted_proxy(remote_addr, proxy_secret=None):
+    # The router also masquerades clients' direct requests to this port, so
+    # its address alone proves nothing: the proxy must send PROXY_SECRET too
+    if not PROXY_SECRET or not proxy_secret:
         return False
+    return remote_addr in proxy_addresses() and hmac.compare_digest(proxy_secret.encode(), PROXY_SECRET.encode())
+
+def client_address(remote_addr, forwarded_for=None, proxy_secret=None):
+    # Splash page requests reach us through the router, which appends the
+    # real client address to X-Forwarded-For
+    if forwarded_for and trusted_proxy(remote_addr, proxy_secret):
+        return forwarded_for.rsplit(',', 1)[-1].strip()
+    return remote_addr
+
+def forwarded_mac(remote_addr, client_mac=None, proxy_secret=None):
+    # The router's API proxy also sends X-Client-MAC from its own neighbor table
+    if client_mac and trusted_proxy(remote_addr, proxy_secret):
+        return client_mac.strip()
+    return None
+
+def resolve_client_mac(client_ip, mac=None):
+    # All state is keyed on the normalized MAC, whatever case the client sent
+    return normalize_mac(neighbor_table.resolve(client_ip) or mac)
+
+def set_router_status(mac, status):
+    with state_lock:
+        client = authenticated_clients.get(mac)
+        if client is not None:
+            client['router_status'] = status
+            persist_entry('client', mac)
+
+class RouterDispatcher:
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.failures = 0
+        self.authorized = 0
+        self.deauthorized = 0
+        self.retry_deauth = {}
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='router-dispatcher', daemon=True)
+                self.thread.start()
+
+    def submit(self, action, mac, ip=None):
+        self.start()
+        self.queue.put((action, mac, ip))
+
+    def submit_many(self, action, clients):
+        self.start()
+        for mac, ip in clients:
+            self.queue.put((action, mac, ip))
+
+    def take_deauth_retries(self):
+        with self.lock:
+            retries = self.retry_deauth
+            self.retry_deauth = {}
+        return list(retries.items())
+
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.window
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+
+            for action, clients in self.group(batch).items():
+                self.dispatch(action, clients)
+
+            for _ in batch:
+                self.queue.task_done()
+
+    def group(self, batch):
+        # Only the most recent action per MAC is applied, so a client that
+        # expired and logged in again within one window stays authorized
+        latest = {}
+        for action, mac, ip in batch:
+            latest.pop(mac, None)
+            latest[mac] = (action, ip)
+
+        by_action = {}
+        for mac, (action, ip) in latest.items():
+            by_action.setdefault(action, []).append((mac, ip))
+        return by_action
+
+    def dispatch(self, action, clients):
+        start = time.perf_counter()
+        try:
+            results = router_batch(action, clients)
+        except Exception as e:
+            log_event(logging.ERROR, 'router_batch_error', "Router {action} batch of {clients} failed: {error}",
+                      action=action, clients=len(clients), error=str(e))
+            results = {}
+
+        self.record_results(action, clients, results, time.perf_counter() - start)
+
+    def record_results(self, action, clients, results, elapsed):
+        failed = []
+        for mac, ip in clients:
+            ok = results.get(mac, False)
+            if not ok:
+                failed.append((mac, ip))
+            if action == 'auth':
+                set_router_status(mac, 'authorized' if ok else 'failed')
+        self.record_batch(action, clients, failed, elapsed)
+
+    def record_batch(self, action, clients, failed, elapsed):
+        stage_latency.observe(elapsed, f'router_{action}_batch')
+        with self.lock:
+            self.batches += 1
+            self.requests += len(clients)
+            self.failures += len(failed)
+            if action == 'auth':
+                self.authorized += len(clients) - len(failed)
+            else:
+                self.deauthorized += len(clients) - len(failed)
+                # Retried on the next expiry sweep so router rules never outlive sessions
+                self.retry_deauth.update(failed)
+
+        log_event(logging.WARNING if failed else logging.INFO, 'router_batch', "Router {action} batch: {ok}/{clients} ok ({elapsed_ms} ms)",
+                  action=action, ok=len(clients) - len(failed), clients=len(clients), elapsed_ms=round(elapsed * 1000))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': self.queue.qsize(),
+                'batches': self.batches,
+                'requests': self.requests,
+                'failures': self.failures,
+                'authorized': self.authorized,
+                'deauthorized': self.deauthorized,
+                'deauth_retry_pending': len(self.retry_deauth),
+                'avg_batch_size': round(self.requests / self.batches, 1) if self.batches else 0
+            }
+
+router_dispatcher = RouterDispatcher(ROUTER_BATCH_WINDOW, ROUTER_BATCH_MAX)
+
+class EventBroker:
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self):
+        subscription = queue.Queue(maxsize=self.queue_size)
+        with self.lock:
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def publish(self, event, data):
+        message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+        with self.lock:
+            self.published += 1
+            for subscription in list(self.subscribers):
+                try:
+                    subscription.put_nowait(message)
+                except queue.Full:
+                    # A dashboard that stopped reading is disconnected; it resyncs
+                    # from the JSON API when the browser reconnects
+                    self.subscribers.discard(subscription)
+                    self.dropped += 1
+                    with subscription.mutex:
+                        subscription.queue.clear()
+                    subscription.put_nowait(None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'subscribers': len(self.subscribers),
+                'published': self.published,
+                'dropped': self.dropped
+            }
+
+event_broker = EventBroker(EVENT_QUEUE_SIZE)
+
+def publish_event(event, **data):
+    if not event_broker.subscribers:
+        return
+    data['stats'] = state_counts()
+    event_broker.publish(event, data)
+
+def entry_expiry(table, data):
+    if table == 'client':
+        return data['expires']
+    return data['created'] + OTP_VALIDITY
+
+def expiry_table(table):
+    if table == 'otp':
+        return active_otps
+    if table == 'client':
+        return authenticated_clients
+    return pending_registrations
+
+def schedule_expiry(table, key, data):
+    with state_lock:
+        heapq.heappush(expiry_heap, (entry_expiry(table, data), table, key))
 
 def cleanup_expired():
+    start = time.perf_counter()
     current_time = time.time()
+    expired = 0
+    expired_clients = []
+    expired_keys = {'otp': [], 'client': [], 'pending': []}
+
+    with state_lock:
+        while expiry_heap and expiry_heap[0][0] < current_time:
+            expires_at, table, key = heapq.heappop(expiry_heap)
+            entries = expiry_table(table)
+            data = entries.get(key)
+
+            # Entries that were replaced or removed leave a stale heap item behind
+            if data is None or entry_expiry(table, data) != expires_at:
+                continue
+
+            del entries[key]
+            if table == 'otp':
+                unindex_otp_request(key, data)
+                if data['used']:
+                    state_counters['used_otps'] -= 1
+            expired_keys[table].append(key)
+            expired += 1
+
+            # With a shared store, purge_expired() removes the row and deauthorizes
+            # the client exactly once across all workers
+            if STATE_SHARED:
+                continue
+            state_backend.delete(table, key)
+            if table == 'client':
+                expired_clients.append((key, data.get('ip')))
+
+    if expired:
+        with state_lock:
+            state_counters['expired'] += expired
+        mark_state_changed()
+    deauth_router_clients(expired_clients)
+    if expired:
+        publish_event('expire', otps=expired_keys['otp'], clients=expired_keys['client'])
+
+    stage_latency.observe(time.perf_counter() - start, 'cleanup_expired')
+    return expired
+
+def deauth_router_clients(expired_clients):
+    retries = router_dispatcher.take_deauth_retries()
+    if not expired_clients and not retries:
+        return
+
+    with state_lock:
+        # A MAC that logged in again since it expired must keep its access
+        stale = [(mac, ip) for mac, ip in expired_clients + retries
+                 if lookup_entry('client', mac) is None]
+
+    if stale:
+        router_dispatcher.submit_many('deauth', stale)
+        log_event(logging.INFO, 'router_deauth_expired', "Deauthorizing {clients} expired client(s) on router", clients=len(stale))
+
+def reap_expired():
+    cleanup_expired()
+    if STATE_SHARED:
+        deauth_router_clients(state_backend.purge_expired())
 
-    expired_otps = [otp for otp, data in active_otps.items()
-                    if current_time - data['created'] > OTP_VALIDITY]
-    for otp in expired_otps:
-        del active_otps[otp]
+def expiry_reaper():
+    while True:
+        time.sleep(CLEANUP_INTERVAL)
+        try:
+            reap_expired()
+        except Exception as e:
+            log_event(logging.ERROR, 'reaper_error', "Expiry reaper error: {error}", error=str(e))
 
-    expired_clients = [mac for mac, data in authenticated_clients.items()
-                      if current_time > data['expires']]
-    for mac in expired_clients:
-        del authenticated_clients[mac]
+def start_expiry_reaper():
+    reaper = threading.Thread(target=expiry_reaper, name='expiry-reaper', daemon=True)
+    reaper.start()
+    return reaper
 
-    expired_pending = [email for email, data in pending_registrations.items()
-                      if current_time - data['created'] > OTP_VALIDITY]
-    for email in expired_pending:
-        del pending_registrations[email]
+class MemoryStateBackend:
+    name = 'memory'
 
-@app.route('/')
-def index():
-    cleanup_expired()
+    def load(self):
+        return []
 
-    html = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>OTP Auth Server - Admin Dashboard</title>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <style>
-            * {
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-            }
-            body {
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                padding: 20px;
-                min-height: 100vh;
-            }
-            .container {
-                max-width: 1400px;
-                margin: 0 auto;
-            }
-            h1 {
-                color: white;
-                text-align: center;
-                margin-bottom: 30px;
-                font-size: 32px;
-            }
-            .stats {
-                display: grid;
-                grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
-                gap: 20px;
-                margin-bottom: 30px;
-            }
-            .stat-card {
-                background: white;
-                padding: 20px;
-                border-radius: 10px;
-                box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-            }
-            .stat-card h3 {
-                color: #666;
-                font-size: 14px;
-                margin-bottom: 10px;
-            }
-            .stat-card .value {
-                color: #764ba2;
-                font-size: 32px;
-                font-weight: bold;
-            }
-            .section {
-                background: white;
-                padding: 25px;
-                border-radius: 10px;
-                margin-bottom: 20px;
-                box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-            }
-            .section h2 {
-                color: #333;
-                margin-bottom: 20px;
-                padding-bottom: 10px;
-                border-bottom: 2px solid #764ba2;
-            }
-            .refresh-btn {
-                background: linear-gradient(135deg, #11998e 0%, #38ef7d 100%);
-                color: white;
-                border: none;
-                padding: 10px 20px;
-                border-radius: 25px;
-                cursor: pointer;
-                font-size: 14px;
-                font-weight: 600;
-                margin-bottom: 15px;
-                box-shadow: 0 4px 15px rgba(56, 239, 125, 0.3);
-                transition: all 0.3s ease;
-            }
-            .refresh-btn:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 6px 20px rgba(56, 239, 125, 0.5);
-            }
-            table {
-                width: 100%;
-                border-collapse: collapse;
-                overflow-x: auto;
-                display: block;
-            }
-            thead, tbody { display: table; width: 100%; table-layout: fixed; }
-            th, td {
-                padding: 12px;
-                text-align: left;
-                border-bottom: 1px solid #ddd;
-                word-wrap: break-word;
-            }
-            th {
-                background: #f8f9fa;
-                color: #333;
-                font-weight: 600;
-            }
-            tr:hover {
-                background: #f8f9fa;
-            }
-            .otp-code {
-                font-family: 'Courier New', monospace;
-                font-size: 20px;
-                font-weight: bold;
-                color: #38ef7d;
-                letter-spacing: 3px;
+    def save(self, table, key, data):
+        pass
+
+    def delete(self, table, key):
+        pass
+
+    def save_many(self, table, items):
+        pass
+
+    def delete_many(self, table, keys):
+        pass
+
+    def save_otp_claim(self, key, step, expires_at):
+        pass
+
+    def load_otp_claims(self):
+        return []
+
+    def load_secret(self, name, default):
+        return default
+
+    def purge_expired(self):
+        return []
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {'backend': self.name}
+
+class SQLiteStateBackend:
+    name = 'sqlite'
+
+    TABLES = {
+        'otp': ('otp_requests', 'email', ('otp', 'created', 'used', 'mac')),
+        'client': ('clients', 'mac', ('token', 'email', 'expires', 'otp_used', 'ip', 'router_status')),
+        'pending': ('pending', 'email', ('created', 'otp', 'mac'))
+    }
+    COLUMN_TYPES = {'created': 'REAL', 'expires': 'REAL', 'used': 'BOOLEAN'}
+    INDEXES = [('otp_requests', 'mac'), ('clients', 'otp_used'), ('pending', 'mac')]
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.local = threading.local()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.commits = 0
+        self.thread = None
+
+        self.upsert_sql = {}
+        self.delete_sql = {}
+        self.select_sql = {}
+        self.fetch_sql = {}
+        for kind, (table, key, fields) in self.TABLES.items():
+            columns = ', '.join((key,) + fields + ('expires_at',))
+            placeholders = ', '.join('?' * (len(fields) + 2))
+            self.upsert_sql[kind] = f"INSERT OR REPLACE INTO {table} ({columns}) VALUES ({placeholders})"
+            self.delete_sql[kind] = f"DELETE FROM {table} WHERE {key} = ?"
+            self.select_sql[kind] = f"SELECT {', '.join((key,) + fields)}, expires_at FROM {table} WHERE expires_at >= ?"
+            self.fetch_sql[kind] = f"SELECT {', '.join(fields)} FROM {table} WHERE {key} = ? AND expires_at >= ?"
+
+        conn = self.connect()
+        with conn:
+            for kind, (table, key, fields) in self.TABLES.items():
+                columns = ', '.join(f"{field} {self.COLUMN_TYPES.get(field, 'TEXT')}" for field in fields)
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({key} TEXT PRIMARY KEY, {columns}, expires_at REAL NOT NULL)")
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_expires_at ON {table} (expires_at)")
+            for table, column in self.INDEXES:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})")
+            conn.execute("CREATE TABLE IF NOT EXISTS otp_claims (key TEXT PRIMARY KEY, step INTEGER NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS secrets (name TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        conn.close()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+
+    def load(self):
+        conn = self.connect()
+        try:
+            now = time.time()
+            rows = []
+            for kind, (table, key, fields) in self.TABLES.items():
+                rows.extend((kind, row[0], dict(zip(fields, row[1:-1])), row[-1])
+                            for row in conn.execute(self.select_sql[kind], (now,)))
+            return rows
+        finally:
+            conn.close()
+
+    def purge_expired(self):
+        conn = self.connection()
+        now = time.time()
+
+        # BEGIN IMMEDIATE takes the write lock first, so concurrent workers never
+        # both see the same expired session
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            expired_clients = conn.execute("SELECT mac, ip FROM clients WHERE expires_at < ?", (now,)).fetchall()
+            for table, key, fields in self.TABLES.values():
+                conn.execute(f"DELETE FROM {table} WHERE expires_at < ?", (now,))
+            conn.execute("DELETE FROM otp_claims WHERE expires_at < ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return expired_clients
+
+    def fetch(self, table, key):
+        fields = self.TABLES[table][2]
+        row = self.connection().execute(self.fetch_sql[table], (key, time.time())).fetchone()
+        return dict(zip(fields, row)) if row else None
+
+    def fetch_otp_by_mac(self, mac):
+        fields = self.TABLES['otp'][2]
+        row = self.connection().execute(
+            f"SELECT email, {', '.join(fields)} FROM otp_requests WHERE mac = ? AND expires_at >= ? ORDER BY created DESC LIMIT 1",
+            (mac, time.time())
+        ).fetchone()
+        return (row[0], dict(zip(fields, row[1:]))) if row else (None, None)
+
+    def claim_otp(self, email, otp, mac):
+        with self.connection() as conn:
+            cursor = conn.execute("UPDATE otp_requests SET used = 1, mac = ? WHERE email = ? AND otp = ? AND used = 0 AND expires_at >= ?",
+                                  (mac, email, otp, time.time()))
+        self.record_commit(1)
+        return cursor.rowcount == 1
+
+    def claim_otp_step(self, key, step, expires_at):
+        # Succeeds only when no claim for this email covers the step already
+        with self.connection() as conn:
+            cursor = conn.execute(
+                "INSERT INTO otp_claims (key, step, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET step = excluded.step, expires_at = excluded.expires_at "
+                "WHERE excluded.step > otp_claims.step",
+                (key, step, expires_at))
+        self.record_commit(1)
+        return cursor.rowcount == 1
+
+    def save_otp_claim(self, key, step, expires_at):
+        self.start()
+        self.queue.put(("INSERT OR REPLACE INTO otp_claims (key, step, expires_at) VALUES (?, ?, ?)", [(key, step, expires_at)]))
+
+    def load_otp_claims(self):
+        conn = self.connect()
+        try:
+            return conn.execute("SELECT key, step FROM otp_claims WHERE expires_at >= ?", (time.time(),)).fetchall()
+        finally:
+            conn.close()
+
+    def load_secret(self, name, default):
+        # The first process to store a value wins; restarts and other workers adopt it
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO secrets (name, value) VALUES (?, ?)", (name, default))
+            return conn.execute("SELECT value FROM secrets WHERE name = ?", (name,)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def counts(self):
+        conn = self.connection()
+        now = time.time()
+        active, used = conn.execute("SELECT COUNT(*) - COALESCE(SUM(used), 0), COALESCE(SUM(used), 0) FROM otp_requests WHERE expires_at >= ?", (now,)).fetchone()
+        clients = conn.execute("SELECT COUNT(*) FROM clients WHERE expires_at >= ?", (now,)).fetchone()[0]
+        pending = conn.execute("SELECT COUNT(*) FROM pending WHERE expires_at >= ?", (now,)).fetchone()[0]
+        return {'active_otps': active, 'used_otps': used, 'authenticated_clients': clients, 'pending': pending}
+
+    def record_commit(self, writes):
+        with self.lock:
+            self.writes += writes
+            self.commits += 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='state-writer', daemon=True)
+                self.thread.start()
+
+    def row_params(self, table, key, data):
+        fields = self.TABLES[table][2]
+        return (key,) + tuple(data.get(field) for field in fields) + (entry_expiry(table, data),)
+
+    def save(self, table, key, data):
+        if self.shared:
+            # Other workers read straight from the database, so commit before returning
+            with self.connection() as conn:
+                conn.execute(self.upsert_sql[table], self.row_params(table, key, data))
+            self.record_commit(1)
+            return
+
+        self.start()
+        self.queue.put((self.upsert_sql[table], [self.row_params(table, key, data)]))
+
+    def delete(self, table, key):
+        self.start()
+        self.queue.put((self.delete_sql[table], [(key,)]))
+
+    def save_many(self, table, items):
+        self.write_many(self.upsert_sql[table], [self.row_params(table, key, data) for key, data in items])
+
+    def delete_many(self, table, keys):
+        self.write_many(self.delete_sql[table], [(key,) for key in keys])
+
+    def write_many(self, sql, rows):
+        # The whole batch is one queue item, so the writer commits it in one transaction
+        if not rows:
+            return
+        if self.shared:
+            with self.connection() as conn:
+                conn.executemany(sql, rows)
+            self.record_commit(len(rows))
+            return
+
+        self.start()
+        self.queue.put((sql, rows))
+
+    def drain(self, items):
+        while len(items) < STATE_FLUSH_BATCH:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def run(self):
+        conn = self.connect()
+        running = True
+
+        while running:
+            items = [self.queue.get()]
+            self.drain(items)
+            if len(items) < STATE_FLUSH_BATCH:
+                # Light load: wait a little so the next commit covers more writes
+                time.sleep(STATE_FLUSH_INTERVAL)
+                self.drain(items)
+
+            ops = [item for item in items if item is not None]
+            running = len(ops) == len(items)
+
+            try:
+                with conn:
+                    # Consecutive writes of the same statement go through one executemany()
+                    start = 0
+                    while start < len(ops):
+                        end = start
+                        while end < len(ops) and ops[end][0] == ops[start][0]:
+                            end += 1
+                        conn.executemany(ops[start][0], [params for _, rows in ops[start:end] for params in rows])
+                        start = end
+                self.record_commit(sum(len(rows) for _, rows in ops))
+            except sqlite3.Error as e:
+                log_event(logging.ERROR, 'state_write_failed', "State write failed: {error}", error=str(e))
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+        conn.close()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(EMAIL_SHUTDOWN_TIMEOUT)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': self.name,
+                'path': self.path,
+                'shared': self.shared,
+                'pending_writes': self.queue.qsize(),
+                'writes': self.writes,
+                'commits': self.commits
             }
-            .status {
-                padding: 5px 10px;
-                border-radius: 15px;
-                font-size: 12px;
-                font-weight: bold;
+
+sqlite3.register_converter('BOOLEAN', lambda value: value == b'1')
+
+state_backend = MemoryStateBackend()
+
+def persist_entry(table, key):
+    data = expiry_table(table).get(key)
+    if data is not None:
+        state_backend.save(table, key, data)
+
+def lookup_entry(table, key):
+    if STATE_SHARED:
+        return state_backend.fetch(table, key)
+    return expiry_table(table).get(key)
+
+def mark_state_changed():
+    global state_version
+    with state_lock:
+        state_version += 1
+
+def store_entry(table, key, data):
+    with state_lock:
+        expiry_table(table)[key] = data
+        schedule_expiry(table, key, data)
+        persist_entry(table, key)
+        mark_state_changed()
+
+def find_otp_request(email, mac):
+    if email:
+        return email, lookup_entry('otp', email)
+
+    if STATE_SHARED:
+        return state_backend.fetch_otp_by_mac(mac)
+
+    with state_lock:
+        email = otp_requests_by_mac.get(mac)
+        data = active_otps.get(email)
+        if data is None or data.get('mac') != mac:
+            return None, None
+        return email, data
+
+def unindex_otp_request(email, data):
+    mac = data.get('mac')
+    if mac and otp_requests_by_mac.get(mac) == email:
+        del otp_requests_by_mac[mac]
+
+def claim_otp(email, otp, mac):
+    if STATE_SHARED:
+        return state_backend.claim_otp(email, otp, mac)
+
+    with state_lock:
+        otp_data = active_otps.get(email)
+        if otp_data is None or otp_data['used'] or not secrets.compare_digest(otp_data['otp'], otp):
+            return False
+        otp_data['used'] = True
+        otp_data['mac'] = mac
+        state_counters['used_otps'] += 1
+        persist_entry('otp', email)
+        mark_state_changed()
+    return True
+
+def state_snapshot():
+    if not STATE_SHARED:
+        return active_otps, authenticated_clients, pending_registrations
+
+    tables = {'otp': {}, 'client': {}, 'pending': {}}
+    for table, key, data, expires_at in state_backend.load():
+        tables[table][key] = data
+    return tables['otp'], tables['client'], tables['pending']
+
+def state_counts():
+    if STATE_SHARED:
+        return state_backend.counts()
+
+    with state_lock:
+        counts = {
+            'active_otps': len(active_otps) - state_counters['used_otps'],
+            'used_otps': state_counters['used_otps'],
+            'authenticated_clients': len(authenticated_clients),
+            'pending': len(pending_registrations)
+        }
+        if STATS_SELF_CHECK:
+            check_state_counts(counts)
+    return counts
+
+def scan_state_counts():
+    with state_lock:
+        used = len([d for d in active_otps.values() if d['used']])
+        return {
+            'active_otps': len(active_otps) - used,
+            'used_otps': used,
+            'authenticated_clients': len(authenticated_clients),
+            'pending': len(pending_registrations)
+        }
+
+def check_state_counts(counts):
+    scanned = scan_state_counts()
+    if counts != scanned:
+        log_event(logging.ERROR, 'state_counters_drift', "State counters drifted: {counts} != scan {scanned}", counts=counts, scanned=scanned)
+        raise AssertionError(f"state counters {counts} do not match full scan {scanned}")
+
+def init_state_backend():
+    global state_backend, session_token_fallback_key, otp_fallback_secret
+
+    if STATE_SHARED and STATE_BACKEND != 'sqlite':
+        raise SystemExit("STATE_SHARED requires STATE_BACKEND = 'sqlite'")
+
+    if STATE_BACKEND == 'sqlite':
+        state_backend = SQLiteStateBackend(STATE_DB_PATH, shared=STATE_SHARED)
+    else:
+        state_backend = MemoryStateBackend()
+    atexit.register(state_backend.close)
+
+    # Generated keys are kept with the state, so tokens and derived codes
+    # issued before a restart stay valid along with the restored sessions
+    if not SESSION_TOKEN_KEYS:
+        session_token_fallback_key = state_backend.load_secret('session_token_key', session_token_fallback_key)
+    if not OTP_SECRET:
+        otp_fallback_secret = state_backend.load_secret('otp_secret', otp_fallback_secret)
+
+    # Sessions that ran out while the server was down still hold router rules
+    deauth_router_clients(state_backend.purge_expired())
+
+    # Shared workers read through to the database instead of keeping a copy
+    if STATE_SHARED:
+        return state_backend
+
+    start = time.perf_counter()
+    rows = state_backend.load()
+    derived_otp_claims.load(state_backend.load_otp_claims())
+
+    with state_lock:
+        tables = {table: expiry_table(table) for table in ('otp', 'client', 'pending')}
+        for table, key, data, expires_at in rows:
+            tables[table][key] = data
+            if table == 'otp' and data.get('mac'):
+                otp_requests_by_mac[data['mac']] = key
+            if table == 'otp' and data['used']:
+                state_counters['used_otps'] += 1
+        expiry_heap.extend((expires_at, table, key) for table, key, data, expires_at in rows)
+        heapq.heapify(expiry_heap)
+        mark_state_changed()
+
+    if rows:
+        log_event(logging.INFO, 'state_restored', "Restored {entries} state entries from {path} in {elapsed_ms} ms",
+                  entries=len(rows), path=STATE_DB_PATH, elapsed_ms=round((time.perf_counter() - start) * 1000))
+
+    unconfirmed = [(key, data.get('ip')) for table, key, data, expires_at in rows
+                   if table == 'client' and data.get('router_status') != 'authorized']
+    if unconfirmed:
+        router_dispatcher.submit_many('auth', unconfirmed)
+
+    return state_backend
+
+def otp_status(data, now):
+    if data['used']:
+        return 'used'
+    return 'expired' if data['created'] + OTP_VALIDITY <= now else 'active'
+
+def otp_row(email, data, now):
+    return {
+        'email': email,
+        'otp': data['otp'],
+        'mac': data.get('mac'),
+        'created': data['created'],
+        'expires_at': data['created'] + OTP_VALIDITY,
+        'status': otp_status(data, now)
+    }
+
+def client_row(mac, data):
+    return {
+        'mac': mac,
+        'email': data.get('email'),
+        'token': data['token'][:16],
+        'ip': data.get('ip'),
+        'expires': data['expires'],
+        'router_status': data.get('router_status')
+    }
+
+def list_otps(otps, status=None, query=None, offset=0, limit=ADMIN_PAGE_SIZE):
+    now = time.time()
+    items = list(otps.items())
+    if status:
+        items = [(email, data) for email, data in items if otp_status(data, now) == status]
+    if query:
+        items = [(email, data) for email, data in items if query in email or query in (data.get('mac') or '')]
+
+    page = heapq.nlargest(offset + limit, items, key=lambda item: item[1]['created'])[offset:]
+    return len(items), [otp_row(email, data, now) for email, data in page]
+
+def list_clients(clients, router_status=None, query=None, offset=0, limit=ADMIN_PAGE_SIZE):
+    items = list(clients.items())
+    if router_status:
+        items = [(mac, data) for mac, data in items if data.get('router_status') == router_status]
+    if query:
+        items = [(mac, data) for mac, data in items
+                 if query in mac or query in (data.get('email') or '') or query in (data.get('ip') or '')]
+
+    page = heapq.nlargest(offset + limit, items, key=lambda item: item[1]['expires'])[offset:]
+    return len(items), [client_row(mac, data) for mac, data in page]
+
+def page_bounds(offset, limit):
+    try:
+        offset = int(offset or 0)
+        limit = int(limit or ADMIN_PAGE_SIZE)
+    except ValueError:
+        return None
+    if offset < 0 or limit < 1:
+        return None
+    return offset, min(limit, ADMIN_PAGE_MAX)
+
+@app.template_filter('clock')
+def format_clock(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%H:%M:%S')
+
+DASHBOARD_HTML = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>OTP Auth Server - Admin Dashboard</title>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <link rel="stylesheet" href="{{ css_url }}">
+</head>
+<body>
+    <div class="container">
+        <h1>🔐 OTP Authentication Server - Admin Dashboard</h1>
+
+        {% if not email_enabled %}
+        <div class="alert alert-warning">
+            <strong>⚠️ Email Simulation Mode</strong><br>
+            Emails are not actually being sent. OTPs are displayed in the console/logs.<br>
+            To enable real email sending, configure SMTP settings in otp_auth_server.py
+        </div>
+        {% endif %}
+
+        <div class="stats">
+            <div class="stat-card">
+                <h3>Active OTPs</h3>
+                <div class="value" id="stat-active">{{ active_count }}</div>
+            </div>
+            <div class="stat-card">
+                <h3>Authenticated Clients</h3>
+                <div class="value" id="stat-clients">{{ client_count }}</div>
+            </div>
+            <div class="stat-card">
+                <h3>Pending Registrations</h3>
+                <div class="value" id="stat-pending">{{ pending_count }}</div>
+            </div>
+            <div class="stat-card">
+                <h3>Total Generated</h3>
+                <div class="value" id="stat-total">{{ total_count }}</div>
+            </div>
+        </div>
+
+        <div class="toolbar">
+            <input id="filter-q" type="search" placeholder="Filter by email, MAC or IP" oninput="resync()">
+            <select id="filter-status" onchange="resync()">
+                <option value="">All OTPs</option>
+                <option value="active">Active</option>
+                <option value="used">Used</option>
+                <option value="expired">Expired</option>
+            </select>
+            <button class="refresh-btn" onclick="resync()">🔄 Refresh</button>
+        </div>
+
+        <div class="section">
+            <h2>📧 Recent OTP Requests</h2>
+            <table>
+                <thead>
+                    <tr>
+                        <th>OTP Code</th>
+                        <th>Email</th>
+                        <th>Status</th>
+                        <th>Created</th>
+                        <th>Expires In</th>
+                        <th>Used By MAC</th>
+                    </tr>
+                </thead>
+                <tbody id="otp-rows">
+                    {% for row in otps %}
+                    <tr data-key="{{ row.email }}">
+                        <td class="otp-code">{{ row.otp }}</td>
+                        <td class="email">{{ row.email }}</td>
+                        <td><span class="status status-{{ row.status }}">{{ row.status|upper }}</span></td>
+                        <td class="time">{{ row.created|clock }}</td>
+                        <td class="time" data-expires="{{ row.expires_at }}" data-format="seconds"></td>
+                        <td>{{ row.mac or '-' }}</td>
+                    </tr>
+                    {% endfor %}
+                </tbody>
+            </table>
+            <p id="otp-empty" style="text-align: center; color: #666; padding: 20px;" {% if otps %}hidden{% endif %}>No OTP requests yet</p>
+            <button id="more-otps" class="refresh-btn more-btn" onclick="loadPage('otps', true)" {% if otp_total <= otps|length %}hidden{% endif %}>Load more</button>
+        </div>
+
+        <div class="section">
+            <h2>👥 Authenticated Clients</h2>
+            <table>
+                <thead>
+                    <tr>
+                        <th>MAC Address</th>
+                        <th>Email</th>
+                        <th>Session Token</th>
+                        <th>Expires At</th>
+                        <th>Time Remaining</th>
+                    </tr>
+                </thead>
+                <tbody id="client-rows">
+                    {% for row in clients %}
+                    <tr data-key="{{ row.mac }}">
+                        <td><code>{{ row.mac }}</code></td>
+                        <td class="email">{{ row.email or 'N/A' }}</td>
+                        <td><code style="font-size: 11px;">{{ row.token }}...</code></td>
+                        <td class="time">{{ row.expires|clock }}</td>
+                        <td class="time" data-expires="{{ row.expires }}" data-format="minutes"></td>
+                    </tr>
+                    {% endfor %}
+                </tbody>
+            </table>
+            <p id="client-empty" style="text-align: center; color: #666; padding: 20px;" {% if clients %}hidden{% endif %}>No authenticated clients</p>
+            <button id="more-clients" class="refresh-btn more-btn" onclick="loadPage('clients', true)" {% if client_total <= clients|length %}hidden{% endif %}>Load more</button>
+        </div>
+    </div>
+
+    <script>
+        const PAGE_SIZE = {{ page_size }};
+        const tables = {
+            otps: {rows: document.getElementById('otp-rows'), empty: document.getElementById('otp-empty'), more: document.getElementById('more-otps')},
+            clients: {rows: document.getElementById('client-rows'), empty: document.getElementById('client-empty'), more: document.getElementById('more-clients')}
+        };
+        const filterQuery = document.getElementById('filter-q');
+        const filterStatus = document.getElementById('filter-status');
+        let connected = false;
+
+        function escapeHtml(value) {
+            return String(value ?? '').replace(/[&<>"']/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c]));
+        }
+
+        function clock(timestamp) {
+            return new Date(timestamp * 1000).toTimeString().slice(0, 8);
+        }
+
+        function otpRow(otp) {
+            const tr = document.createElement('tr');
+            tr.dataset.key = otp.email;
+            tr.innerHTML = `
+                <td class="otp-code">${escapeHtml(otp.otp)}</td>
+                <td class="email">${escapeHtml(otp.email)}</td>
+                <td><span class="status status-${otp.status}">${otp.status.toUpperCase()}</span></td>
+                <td class="time">${clock(otp.created)}</td>
+                <td class="time" data-expires="${otp.expires_at}" data-format="seconds"></td>
+                <td>${escapeHtml(otp.mac || '-')}</td>`;
+            return tr;
+        }
+
+        function clientRow(client) {
+            const tr = document.createElement('tr');
+            tr.dataset.key = client.mac;
+            tr.innerHTML = `
+                <td><code>${escapeHtml(client.mac)}</code></td>
+                <td class="email">${escapeHtml(client.email || 'N/A')}</td>
+                <td><code style="font-size: 11px;">${escapeHtml(client.token)}...</code></td>
+                <td class="time">${clock(client.expires)}</td>
+                <td class="time" data-expires="${client.expires}" data-format="minutes"></td>`;
+            return tr;
+        }
+
+        function matchesQuery(...values) {
+            const query = filterQuery.value.trim().toLowerCase();
+            return !query || values.some(value => (value || '').includes(query));
+        }
+
+        function findRow(kind, key) {
+            return tables[kind].rows.querySelector(`tr[data-key="${CSS.escape(key)}"]`);
+        }
+
+        function updateEmpty() {
+            Object.values(tables).forEach(table => table.empty.hidden = table.rows.rows.length > 0);
+        }
+
+        function upsert(kind, key, row) {
+            const existing = findRow(kind, key);
+            if (existing) {
+                existing.remove();
             }
-            .status-active {
-                background: #d4edda;
-                color: #155724;
+            if (row) {
+                tables[kind].rows.prepend(row);
             }
-            .status-used {
-                background: #f8d7da;
-                color: #721c24;
+            updateEmpty();
+            tick();
+        }
+
+        function tick() {
+            const now = Date.now() / 1000;
+            document.querySelectorAll('[data-expires]').forEach(cell => {
+                const left = cell.dataset.expires - now;
+                if (left <= 0) {
+                    cell.textContent = 'Expired';
+                } else if (cell.dataset.format === 'seconds') {
+                    cell.textContent = `${Math.floor(left)}s`;
+                } else {
+                    cell.textContent = `${Math.floor(left / 60)}m ${Math.floor(left % 60)}s`;
+                }
+            });
+        }
+
+        function setStats(stats) {
+            document.getElementById('stat-active').textContent = stats.active_otps;
+            document.getElementById('stat-clients').textContent = stats.authenticated_clients;
+            document.getElementById('stat-total').textContent = stats.active_otps + stats.used_otps;
+            if (stats.pending !== undefined) {
+                document.getElementById('stat-pending').textContent = stats.pending;
             }
-            .status-expired {
-                background: #fff3cd;
-                color: #856404;
+        }
+
+        async function loadPage(kind, append) {
+            const table = tables[kind];
+            const params = new URLSearchParams({offset: append ? table.rows.rows.length : 0, limit: PAGE_SIZE});
+            if (filterQuery.value.trim()) {
+                params.set('q', filterQuery.value.trim().toLowerCase());
             }
-            .time {
-                color: #666;
-                font-size: 14px;
+            if (kind === 'otps' && filterStatus.value) {
+                params.set('status', filterStatus.value);
             }
-            .email {
-                color: #764ba2;
-                font-size: 14px;
-                font-weight: 500;
+
+            const data = await (await fetch(`/api/admin/${kind}?${params}`)).json();
+            if (!append) {
+                table.rows.replaceChildren();
             }
-            .alert {
-                background: #d1ecf1;
-                border: 1px solid #bee5eb;
-                color: #0c5460;
-                padding: 15px;
-                border-radius: 8px;
-                margin-bottom: 20px;
+            data.items.forEach(item => table.rows.append(kind === 'otps' ? otpRow(item) : clientRow(item)));
+            table.more.hidden = table.rows.rows.length >= data.total;
+            updateEmpty();
+            tick();
+        }
+
+        function resync() {
+            loadPage('otps', false);
+            loadPage('clients', false);
+            fetch('/api/stats').then(response => response.json()).then(setStats);
+        }
+
+        const events = new EventSource('/api/admin/events');
+
+        events.addEventListener('open', () => {
+            // Events sent while disconnected are lost, so reload the visible pages
+            if (connected) {
+                resync();
             }
-            .alert-warning {
-                background: #fff3cd;
-                border: 1px solid #ffc107;
-                color: #856404;
+            connected = true;
+        });
+
+        events.addEventListener('otp', event => {
+            const data = JSON.parse(event.data);
+            const otp = data.otp;
+            const visible = (!filterStatus.value || filterStatus.value === otp.status) && matchesQuery(otp.email, otp.mac);
+            upsert('otps', otp.email, visible ? otpRow(otp) : null);
+            setStats(data.stats);
+        });
+
+        events.addEventListener('verify', event => {
+            const data = JSON.parse(event.data);
+            const row = findRow('otps', data.email);
+            if (row && filterStatus.value && filterStatus.value !== 'used') {
+                upsert('otps', data.email, null);
+            } else if (row) {
+                row.querySelector('.status').className = 'status status-used';
+                row.querySelector('.status').textContent = 'USED';
+                row.cells[5].textContent = data.mac;
             }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>🔐 OTP Authentication Server - Admin Dashboard</h1>
-
-            {% if not email_enabled %}
-            <div class="alert alert-warning">
-                <strong>⚠️ Email Simulation Mode</strong><br>
-                Emails are not actually being sent. OTPs are displayed in the console/logs.<br>
-                To enable real email sending, configure SMTP settings in otp_auth_server.py
-            </div>
-            {% endif %}
-
-            <div class="stats">
-                <div class="stat-card">
-                    <h3>Active OTPs</h3>
-                    <div class="value">{{ active_count }}</div>
-                </div>
-                <div class="stat-card">
-                    <h3>Authenticated Clients</h3>
-                    <div class="value">{{ client_count }}</div>
-                </div>
-                <div class="stat-card">
-                    <h3>Pending Registrations</h3>
-                    <div class="value">{{ pending_count }}</div>
-                </div>
-                <div class="stat-card">
-                    <h3>Total Generated</h3>
-                    <div class="value">{{ total_count }}</div>
-                </div>
-            </div>
 
-            <div class="section">
-                <h2>📧 Recent OTP Requests</h2>
-                <button class="refresh-btn" onclick="location.reload()">🔄 Refresh</button>
-                <table>
-                    <thead>
-                        <tr>
-                            <th>OTP Code</th>
-                            <th>Email</th>
-                            <th>Status</th>
-                            <th>Created</th>
-                            <th>Expires In</th>
-                            <th>Used By MAC</th>
-                        </tr>
-                    </thead>
-                    <tbody>
-                        {% for otp, data in otps.items() %}
-                        <tr>
-                            <td class="otp-code">{{ otp }}</td>
-                            <td class="email">{{ data.email }}</td>
-                            <td>
-                                {% if data.used %}
-                                    <span class="status status-used">USED</span>
-                                {% elif data.expired %}
-                                    <span class="status status-expired">EXPIRED</span>
-                                {% else %}
-                                    <span class="status status-active">ACTIVE</span>
-                                {% endif %}
-                            </td>
-                            <td class="time">{{ data.created_str }}</td>
-                            <td class="time">{{ data.expires_in }}</td>
-                            <td>{{ data.mac or '-' }}</td>
-                        </tr>
-                        {% endfor %}
-                    </tbody>
-                </table>
-                {% if not otps %}
-                <p style="text-align: center; color: #666; padding: 20px;">No OTP requests yet</p>
-                {% endif %}
-            </div>
+            const client = data.client;
+            upsert('clients', client.mac, matchesQuery(client.mac, client.email, client.ip) ? clientRow(client) : null);
+            setStats(data.stats);
+        });
 
-            <div class="section">
-                <h2>👥 Authenticated Clients</h2>
-                <table>
-                    <thead>
-                        <tr>
-                            <th>MAC Address</th>
-                            <th>Email</th>
-                            <th>Session Token</th>
-                            <th>Expires At</th>
-                            <th>Time Remaining</th>
-                        </tr>
-                    </thead>
-                    <tbody>
-                        {% for mac, data in clients.items() %}
-                        <tr>
-                            <td><code>{{ mac }}</code></td>
-                            <td class="email">{{ data.email }}</td>
-                            <td><code style="font-size: 11px;">{{ data.token[:16] }}...</code></td>
-                            <td class="time">{{ data.expires_str }}</td>
-                            <td class="time">{{ data.time_remaining }}</td>
-                        </tr>
-                        {% endfor %}
-                    </tbody>
-                </table>
-                {% if not clients %}
-                <p style="text-align: center; color: #666; padding: 20px;">No authenticated clients</p>
-                {% endif %}
-            </div>
-        </div>
+        events.addEventListener('bulk', event => {
+            resync();
+        });
 
-        <script>
-            setTimeout(() => location.reload(), 30000);
-        </script>
-    </body>
-    </html>
-    """
+        events.addEventListener('expire', event => {
+            const data = JSON.parse(event.data);
+            data.otps.forEach(key => upsert('otps', key, null));
+            data.clients.forEach(key => upsert('clients', key, null));
+            setStats(data.stats);
+        });
 
-    current_time = time.time()
-    otps_data = {}
-
-    for otp, data in active_otps.items():
-        age = current_time - data['created']
-        expires_in = OTP_VALIDITY - age
-
-        otps_data[otp] = {
-            'email': data['email'],
-            'used': data['used'],
-            'expired': expires_in <= 0,
-            'created_str': datetime.fromtimestamp(data['created']).strftime('%H:%M:%S'),
-            'expires_in': f"{int(expires_in)}s" if expires_in > 0 else "Expired",
-            'mac': data.get('mac', None)
-        }
+        tick();
+        setInterval(tick, 1000);
+    </script>
+</body>
+</html>
+"""
 
-    clients_data = {}
-    for mac, data in authenticated_clients.items():
-        time_remaining = data['expires'] - current_time
-        clients_data[mac] = {
-            'email': data.get('email', 'N/A'),
-            'token': data['token'],
-            'expires_str': datetime.fromtimestamp(data['expires']).strftime('%H:%M:%S'),
-            'time_remaining': f"{int(time_remaining / 60)}m {int(time_remaining % 60)}s"
-        }
+DASHBOARD_TEMPLATE = app.jinja_env.from_string(DASHBOARD_HTML)
+
+with open(os.path.join(app.static_folder, 'dashboard.css'), 'rb') as css_file:
+    DASHBOARD_CSS_VERSION = hashlib.sha1(css_file.read()).hexdigest()[:12]
+
+# Versions restart at zero with the process, so the boot id keeps old ETags from matching
+DASHBOARD_BOOT_ID = secrets.token_hex(4)
 
-    return render_template_string(
-        html,
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = STATIC_MAX_AGE
+
+dashboard_cache = (None, None)
+
+def admin_rejection():
+    rejected = check_admin_token(request.headers.get('Authorization', ''))
+    if rejected is None:
+        return None
+    response = jsonify(rejected[0])
+    response.status_code = rejected[1]
+    if rejected[1] == 401:
+        response.headers['WWW-Authenticate'] = 'Basic realm="OTP admin"'
+    return response
+
+@app.route('/')
+def index():
+    global dashboard_cache
+    rejected = admin_rejection()
+    if rejected:
+        return rejected
+
+    cleanup_expired()
+
+    # A shared store is changed by other workers too, so only a private copy
+    # can be cached against the local version counter
+    if STATE_SHARED:
+        return render_dashboard()
+
+    version = state_version
+    etag = f"{DASHBOARD_BOOT_ID}-{version}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        cached_version, html = dashboard_cache
+        if cached_version != version:
+            html = render_dashboard()
+            dashboard_cache = (version, html)
+        response = Response(html, mimetype='text/html')
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def render_dashboard():
+    otps, clients, pending = state_snapshot()
+    counts = state_counts()
+    otp_total, otp_rows = list_otps(otps)
+    client_total, client_rows = list_clients(clients)
+
+    return DASHBOARD_TEMPLATE.render(
+        css_url=url_for('static', filename='dashboard.css', v=DASHBOARD_CSS_VERSION),
         email_enabled=EMAIL_ENABLED,
-        active_count=len([d for d in active_otps.values() if not d['used']]),
-        client_count=len(authenticated_clients),
-        pending_count=len(pending_registrations),
-        total_count=len(active_otps),
-        otps=otps_data,
-        clients=clients_data
+        active_count=counts['active_otps'],
+        client_count=counts['authenticated_clients'],
+        pending_count=counts['pending'],
+        total_count=counts['active_otps'] + counts['used_otps'],
+        otps=otp_rows,
+        otp_total=otp_total,
+        clients=client_rows,
+        client_total=client_total,
+        page_size=ADMIN_PAGE_SIZE
     )
 
-@app.route('/api/request_otp', methods=['POST'])
-def api_request_otp():
+def issue_otp(email, mac=None):
+    if OTP_MODE == 'derived':
+        with state_lock:
+            state_counters['issued'] += 1
+        return derive_otp(email, int(time.time() // OTP_STEP))
+
+    otp = generate_otp()
+
+    # Codes only need to be unique per requester, so a new request simply
+    # replaces the previous one and generation never has to retry
+    with state_lock:
+        previous = active_otps.get(email)
+        if previous is not None:
+            unindex_otp_request(email, previous)
+            if previous['used']:
+                state_counters['used_otps'] -= 1
+        state_counters['issued'] += 1
+
+        store_entry('otp', email, {
+            'otp': otp,
+            'email': email,
+            'created': time.time(),
+            'used': False,
+            'mac': mac
+        })
+        if mac:
+            otp_requests_by_mac[mac] = email
+        row = otp_row(email, active_otps[email], time.time())
+
+    publish_event('otp', otp=row)
+    return otp
+
+def handle_request_otp(email, mac=None, client_ip=None):
     cleanup_expired()
 
-    data = request.get_json() or {}
-    email = data.get('email', request.form.get('email', '')).strip().lower()
+    email = (email or '').strip().lower()
+    mac = resolve_client_mac(client_ip, mac)
 
     if not email:
-        return jsonify({
+        return {
             'success': False,
             'error': 'Email address is required'
-        }), 400
+        }, 400
 
     if not validate_email(email):
-        return jsonify({
+        return {
             'success': False,
             'error': 'Invalid email format'
-        }), 400
-
-    otp = generate_otp()
-    while otp in active_otps:
-        otp = generate_otp()
-
-    active_otps[otp] = {
-        'email': email,
-        'created': time.time(),
-        'used': False,
-        'mac': None
-    }
+        }, 400
+
+    if RATE_LIMIT_ENABLED:
+        # An address still belonging to the router stands for every client behind
+        # it, so it is not charged to the per-IP bucket
+        limited_ip = client_ip if client_ip not in proxy_addresses() else None
+        allowed, kind, retry_after = rate_limiter.allow([('email', email), ('ip', limited_ip), ('mac', mac)])
+        if not allowed:
+            log_event(logging.WARNING, 'otp_rate_limited', "OTP request for {email} rate limited by {limit} (retry in {retry_after}s)",
+                      email=email, limit=kind, retry_after=retry_after, ip=client_ip, mac=mac)
+            return {
+                'success': False,
+                'error': 'Too many requests. Please wait before requesting another code.',
+                'retry_after': retry_after
+            }, 429
+
+    otp = issue_otp(email, mac)
 
     email_sent = send_email_otp(email, otp)
 
     if not email_sent and EMAIL_ENABLED:
-        return jsonify({
+        return {
             'success': False,
             'error': 'Failed to send email. Please try again.'
-        }), 500
+        }, 500
 
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] 📧 OTP {otp} requested for {email}")
+    log_event(logging.INFO, 'otp_requested', "OTP {otp} requested for {email}", otp=otp, email=email, mac=mac)
 
-    return jsonify({
+    return {
         'success': True,
         'message': 'OTP sent to your email',
-        'validity': OTP_VALIDITY
-    })
-
-@app.route('/api/verify_otp', methods=['POST', 'GET'])
-def api_verify_otp():
-    cleanup_expired()
+        'validity': OTP_VALIDITY,
+        'mac': mac
+    }, 200
 
-    if request.method == 'POST':
-        data = request.get_json() or {}
-        otp = data.get('otp', request.form.get('otp'))
-        mac = data.get('mac', request.form.get('mac'))
-    else:
-        otp = request.args.get('otp')
-        mac = request.args.get('mac')
-
-    if not otp or not mac:
-        return jsonify({
-            'success': False,
-            'error': 'Missing OTP or MAC address'
-        }), 400
+def check_stored_otp(email, otp, mac):
+    email, otp_data = find_otp_request(email, mac)
 
-    if otp not in active_otps:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Invalid OTP attempt: {otp} from {mac}")
-        return jsonify({
+    if not valid_otp_code(otp) or otp_data is None or not secrets.compare_digest(otp_data['otp'], otp):
+        log_event(logging.WARNING, 'otp_invalid', "Invalid OTP attempt: {otp} from {mac}", otp=otp, mac=mac, email=email)
+        return email, ({
             'success': False,
             'error': 'Invalid OTP code'
-        }), 401
-
-    otp_data = active_otps[otp]
+        }, 401)
 
     if otp_data['used']:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ OTP already used: {otp}")
-        return jsonify({
+        log_event(logging.WARNING, 'otp_reused', "OTP already used: {otp}", otp=otp, mac=mac, email=email)
+        return email, ({
             'success': False,
             'error': 'This OTP has already been used'
-        }), 401
+        }, 401)
 
     age = time.time() - otp_data['created']
     if age > OTP_VALIDITY:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Expired OTP: {otp}")
-        return jsonify({
+        log_event(logging.WARNING, 'otp_expired', "Expired OTP: {otp}", otp=otp, mac=mac, email=email)
+        return email, ({
             'success': False,
             'error': 'OTP has expired. Please request a new one.'
-        }), 401
+        }, 401)
+
+    if not claim_otp(email, otp, mac):
+        log_event(logging.WARNING, 'otp_reused', "OTP already used: {otp}", otp=otp, mac=mac, email=email)
+        return email, ({
+            'success': False,
+            'error': 'This OTP has already been used'
+        }, 401)
 
-    otp_data['used'] = True
-    otp_data['mac'] = mac
+    return email, None
 
-    token = secrets.token_urlsafe(32)
-    authenticated_clients[mac] = {
-        'token': token,
-        'email': otp_data['email'],
-        'expires': time.time() + SESSION_DURATION,
-        'otp_used': otp
-    }
+def check_derived_otp(email, otp, mac):
+    # Nothing was stored at issue time: recompute the codes still in the
+    # window, then record the matching step so the code works only once
+    if not email:
+        return email, ({
+            'success': False,
+            'error': 'Email address is required'
+        }, 400)
+
+    step = match_derived_otp(email, otp)
+    if step is None:
+        log_event(logging.WARNING, 'otp_invalid', "Invalid OTP attempt: {otp} from {mac}", otp=otp, mac=mac, email=email)
+        return email, ({
+            'success': False,
+            'error': 'Invalid OTP code'
+        }, 401)
+
+    if not claim_derived_otp(email, step):
+        log_event(logging.WARNING, 'otp_reused', "OTP already used: {otp}", otp=otp, mac=mac, email=email)
+        return email, ({
+            'success': False,
+            'error': 'This OTP has already been used'
+        }, 401)
+
+    return email, None
 
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Authenticated: {mac} ({otp_data['email']}) with OTP {otp}")
+def handle_verify_otp(otp, mac, client_ip, email=None):
+    cleanup_expired()
 
-    client_ip = request.remote_addr
-    router_auth_success = authenticate_on_router(mac, client_ip)
+    email = email.strip().lower() if isinstance(email, str) else ''
+    mac = resolve_client_mac(client_ip, mac)
 
-    if not router_auth_success:
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Warning: Router authentication failed for {mac}, but client is authenticated in OTP server")
+    if not otp or not mac:
+        return {
+            'success': False,
+            'error': 'Missing OTP or MAC address'
+        }, 400
 
-    return jsonify({
+    with state_lock:
+        if OTP_MODE == 'derived':
+            email, rejected = check_derived_otp(email, otp, mac)
+        else:
+            email, rejected = check_stored_otp(email, otp, mac)
+        if rejected:
+            return rejected
+
+        expires = time.time() + SESSION_DURATION
+        token = issue_session_token(mac, email, expires)
+        state_counters['verified'] += 1
+        store_entry('client', mac, {
+            'token': token,
+            'email': email,
+            'expires': expires,
+            'otp_used': otp,
+            'ip': client_ip,
+            'router_status': 'pending'
+        })
+        client = client_row(mac, authenticated_clients[mac])
+
+    log_event(logging.INFO, 'client_authenticated', "Authenticated: {mac} ({email}) with OTP {otp}", mac=mac, email=email, otp=otp, ip=client_ip)
+
+    router_dispatcher.submit('auth', mac, client_ip)
+    publish_event('verify', email=email, mac=mac, client=client)
+
+    return {
         'success': True,
         'token': token,
         'expires_in': SESSION_DURATION,
         'message': 'Authentication successful',
-        'router_auth': router_auth_success
-    })
+        'router_auth': 'pending'
+    }, 200
+
+def handle_check_auth(mac, client_ip=None, token=None):
+    mac = resolve_client_mac(client_ip, mac)
+
+    # A signed token is checked on its own, without touching session state
+    if token:
+        claims = verify_session_token(token, mac)
+        if claims is None:
+            return {'authenticated': False, 'error': 'Invalid or expired session token'}, 401
+        return {
+            'authenticated': True,
+            'mac': claims['mac'],
+            'email_hash': claims['email_hash'],
+            'expires_in': int(claims['expires'] - time.time()),
+            'verified_by': 'token'
+        }, 200
 
-@app.route('/api/check_auth', methods=['GET', 'POST'])
-def api_check_auth():
     cleanup_expired()
-
-    mac = request.args.get('mac') or (request.get_json() or {}).get('mac')
-
     if not mac:
-        return jsonify({'authenticated': False}), 400
+        return {'authenticated': False}, 400
 
-    if mac in authenticated_clients:
-        data = authenticated_clients[mac]
+    data = lookup_entry('client', mac)
+    if data is not None:
         if time.time() < data['expires']:
-            return jsonify({
+            return {
                 'authenticated': True,
                 'email': data.get('email'),
-                'expires_in': int(data['expires'] - time.time())
-            })
+                'expires_in': int(data['expires'] - time.time()),
+                'router_status': data.get('router_status')
+            }, 200
+
+    return {'authenticated': False}, 200
+
+def handle_stats():
+    cleanup_expired()
+
+    counts = state_counts()
+
+    return {
+        'active_otps': counts['active_otps'],
+        'used_otps': counts['used_otps'],
+        'authenticated_clients': counts['authenticated_clients'],
+        'total_otps': counts['active_otps'] + counts['used_otps'],
+        'issued_otps': state_counters['issued'],
+        'verified_logins': state_counters['verified'],
+        'expired_entries': state_counters['expired'],
+        'email_enabled': EMAIL_ENABLED,
+        'otp_mode': OTP_MODE,
+        'derived_otp_claims': len(derived_otp_claims),
+        'email_queue': email_queue.stats(),
+        'neighbors': neighbor_table.stats(),
+        'router_dispatcher': router_dispatcher.stats(),
+        'rate_limiter': rate_limiter.stats(),
+        'events': event_broker.stats(),
+        'logging': log_stats(),
+        'state': state_backend.stats()
+    }, 200
+
+def handle_admin_otps(status=None, query=None, offset=None, limit=None):
+    cleanup_expired()
+
+    bounds = page_bounds(offset, limit)
+    if bounds is None:
+        return {
+            'success': False,
+            'error': 'offset and limit must be non-negative integers'
+        }, 400
+
+    if status and status not in ('active', 'used', 'expired'):
+        return {
+            'success': False,
+            'error': 'status must be active, used or expired'
+        }, 400
+
+    otps, clients, pending = state_snapshot()
+    total, rows = list_otps(otps, status, (query or '').strip().lower(), *bounds)
+    return {'total': total, 'offset': bounds[0], 'limit': bounds[1], 'items': rows}, 200
+
+def handle_admin_clients(router_status=None, query=None, offset=None, limit=None):
+    cleanup_expired()
+
+    bounds = page_bounds(offset, limit)
+    if bounds is None:
+        return {
+            'success': False,
+            'error': 'offset and limit must be non-negative integers'
+        }, 400
+
+    if router_status and router_status not in ('pending', 'authorized', 'failed'):
+        return {
+            'success': False,
+            'error': 'router_status must be pending, authorized or failed'
+        }, 400
+
+    otps, clients, pending = state_snapshot()
+    total, rows = list_clients(clients, router_status, (query or '').strip().lower(), *bounds)
+    return {'total': total, 'offset': bounds[0], 'limit': bounds[1], 'items': rows}, 200
+
+def parse_bulk_csv(text):
+    # Columns are mac, ip, email; a header row may name them in any order
+    rows = [row for row in csv.reader(io.StringIO(text)) if row and any(cell.strip() for cell in row)]
+    columns = ['mac', 'ip', 'email']
+    if rows and rows[0][0].strip().lower() in columns:
+        columns = [cell.strip().lower() for cell in rows.pop(0)]
+    return [dict(zip(columns, (cell.strip() for cell in row))) for row in rows]
+
+def bulk_entries(items, email=None):
+    entries = {}
+    invalid = []
+    for item in items:
+        if not isinstance(item, dict):
+            item = {'mac': item}
+        mac = normalize_mac(item.get('mac'))
+        if mac is None:
+            invalid.append({'mac': item.get('mac'), 'status': 'invalid', 'error': 'Invalid MAC address'})
+            continue
+        # A MAC listed twice keeps its last row
+        entries.pop(mac, None)
+        entries[mac] = (item.get('ip') or None, (item.get('email') or email or '').strip().lower() or None)
+    return [(mac, ip, client_email) for mac, (ip, client_email) in entries.items()], invalid
+
+def bulk_router_update(action, clients):
+    start = time.perf_counter()
+    try:
+        results, error = router_batch(action, clients, timeout=ADMIN_BULK_TIMEOUT), None
+    except Exception as e:
+        log_event(logging.ERROR, 'router_batch_error', "Router {action} batch of {clients} failed: {error}",
+                  action=action, clients=len(clients), error=str(e))
+        results, error = {}, str(e)
+    elapsed = time.perf_counter() - start
+
+    failed = [(mac, ip) for mac, ip in clients if not results.get(mac, False)]
+    router_dispatcher.record_batch(action, clients, failed, elapsed)
+    return results, error, elapsed
+
+def bulk_response(action, start, results, router_error, router_elapsed):
+    elapsed = time.perf_counter() - start
+    stage_latency.observe(elapsed, f'admin_bulk_{action}')
+    failed = sum(item['status'] == 'failed' for item in results)
+    invalid = sum(item['status'] == 'invalid' for item in results)
+
+    log_event(logging.WARNING if failed or invalid else logging.INFO, 'admin_bulk',
+              "Bulk {action}: {ok}/{clients} clients ok, {invalid} invalid ({elapsed_ms} ms)",
+              action=action, ok=len(results) - failed - invalid, clients=len(results), invalid=invalid,
+              elapsed_ms=round(elapsed * 1000))
+    publish_event('bulk', action=action, clients=len(results) - invalid)
+
+    return {
+        'success': not failed and not invalid,
+        'action': action,
+        'requested': len(results),
+        'succeeded': len(results) - failed - invalid,
+        'failed': failed,
+        'invalid': invalid,
+        'router_error': router_error,
+        'router_ms': round(router_elapsed * 1000, 1),
+        'elapsed_ms': round(elapsed * 1000, 1),
+        'results': results
+    }, 200
+
+def check_admin_token(authorization):
+    # Captive clients can reach the API, so the dashboard and admin calls need
+    # ADMIN_TOKEN and are refused outright while it is unset. Browsers send it
+    # as the Basic auth password, which they repeat for the dashboard's own
+    # fetch and EventSource requests
+    if not ADMIN_TOKEN:
+        return {'success': False, 'error': 'Admin endpoints are disabled until ADMIN_TOKEN is set'}, 403
+    if authorization.startswith('Bearer '):
+        token = authorization[7:].strip()
+    elif authorization.startswith('Basic '):
+        try:
+            token = base64.b64decode(authorization[6:]).decode().partition(':')[2]
+        except ValueError:
+            token = ''
+    else:
+        token = ''
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return {'success': False, 'error': 'Invalid or missing admin token'}, 401
+    return None
+
+def check_bulk_size(entries, invalid):
+    if not entries and not invalid:
+        return {'success': False, 'error': 'No clients given'}, 400
+    if len(entries) > ADMIN_BULK_MAX:
+        return {'success': False, 'error': f'At most {ADMIN_BULK_MAX} clients per request'}, 413
+    return None
+
+def handle_admin_bulk_auth(items, duration=None, email=None):
+    start = time.perf_counter()
+    cleanup_expired()
+
+    if items is None:
+        return {'success': False, 'error': 'Send a JSON list of clients or a CSV file'}, 400
+    try:
+        duration = int(duration or SESSION_DURATION)
+    except (TypeError, ValueError):
+        duration = 0
+    if duration <= 0:
+        return {'success': False, 'error': 'duration must be a positive number of seconds'}, 400
+
+    entries, results = bulk_entries(items, email)
+    error = check_bulk_size(entries, results)
+    if error:
+        return error
+
+    # One router commit first, so every stored session already carries its router status
+    clients = [(mac, ip) for mac, ip, client_email in entries]
+    router_results, router_error, router_elapsed = bulk_router_update('auth', clients) if clients else ({}, None, 0)
+
+    expires = time.time() + duration
+    rows = []
+    with state_lock:
+        for mac, ip, client_email in entries:
+            ok = router_results.get(mac, False)
+            data = {
+                'token': issue_session_token(mac, client_email, expires),
+                'email': client_email,
+                'expires': expires,
+                'otp_used': None,
+                'ip': ip,
+                'router_status': 'authorized' if ok else 'failed'
+            }
+            authenticated_clients[mac] = data
+            heapq.heappush(expiry_heap, (expires, 'client', mac))
+            rows.append((mac, data))
+            results.append({'mac': mac, 'ip': ip, 'status': 'authorized' if ok else 'failed'})
+        state_backend.save_many('client', rows)
+        mark_state_changed()
+
+    return bulk_response('auth', start, results, router_error, router_elapsed)
+
+def handle_admin_bulk_deauth(items, everyone=False):
+    start = time.perf_counter()
+    cleanup_expired()
+
+    if everyone:
+        items = list(state_snapshot()[1])
+    if items is None:
+        return {'success': False, 'error': 'Send a JSON list of clients, a CSV file or {"all": true}'}, 400
+
+    entries, results = bulk_entries(items)
+    error = check_bulk_size(entries, results)
+    if error:
+        return error
+
+    clients = []
+    removed = set()
+    with state_lock:
+        for mac, ip, client_email in entries:
+            data = lookup_entry('client', mac)
+            authenticated_clients.pop(mac, None)
+            if data is not None:
+                removed.add(mac)
+                ip = data.get('ip') or ip
+            clients.append((mac, ip))
+        state_backend.delete_many('client', sorted(removed))
+        mark_state_changed()
+
+    # MACs without a session are still sent, in case the router holds them from elsewhere
+    router_results, router_error, router_elapsed = bulk_router_update('deauth', clients)
+    results.extend({
+        'mac': mac,
+        'ip': ip,
+        'status': 'deauthorized' if router_results.get(mac, False) else 'failed',
+        'had_session': mac in removed
+    } for mac, ip in clients)
+
+    return bulk_response('deauth', start, results, router_error, router_elapsed)
+
+def bulk_request():
+    # JSON (a list, or an object with `clients`), a CSV body or a multipart CSV upload
+    options = dict(request.args.items())
+    upload = next(iter(request.files.values()), None)
+    if upload is not None:
+        options.update(request.form.items())
+        return parse_bulk_csv(upload.read().decode('utf-8-sig', errors='replace')), options
+    if request.mimetype in ('text/csv', 'text/plain'):
+        return parse_bulk_csv(request.get_data(as_text=True)), options
+
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        options.update((key, value) for key, value in data.items() if key != 'clients')
+        data = data.get('clients')
+    return (data if isinstance(data, list) else None), options
+
+def event_stream():
+    subscription = event_broker.subscribe()
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                message = subscription.get(timeout=EVENT_HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if message is None:
+                break
+            yield message
+    finally:
+        event_broker.unsubscribe(subscription)
+
+@app.route('/api/request_otp', methods=['POST'])
+def api_request_otp():
+    data = request.get_json(silent=True) or {}
+    payload, status = handle_request_otp(
+        data.get('email', request.form.get('email', '')),
+        forwarded_mac(request.remote_addr, request.headers.get('X-Client-MAC'), request.headers.get('X-Proxy-Secret')) or data.get('mac', request.form.get('mac')),
+        client_address(request.remote_addr, request.headers.get('X-Forwarded-For'), request.headers.get('X-Proxy-Secret'))
+    )
+    return jsonify(payload), status
+
+@app.route('/api/verify_otp', methods=['POST', 'GET'])
+def api_verify_otp():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        otp = data.get('otp', request.form.get('otp'))
+        mac = data.get('mac', request.form.get('mac'))
+        email = data.get('email', request.form.get('email'))
+    else:
+        otp = request.args.get('otp')
+        mac = request.args.get('mac')
+        email = request.args.get('email')
 
-    return jsonify({'authenticated': False})
+    mac = forwarded_mac(request.remote_addr, request.headers.get('X-Client-MAC'), request.headers.get('X-Proxy-Secret')) or mac
+    payload, status = handle_verify_otp(otp, mac, client_address(request.remote_addr, request.headers.get('X-Forwarded-For'), request.headers.get('X-Proxy-Secret')), email)
+    return jsonify(payload), status
+
+@app.route('/api/check_auth', methods=['GET', 'POST'])
+def api_check_auth():
+    mac = request.args.get('mac') or (request.get_json(silent=True) or {}).get('mac')
+    mac = forwarded_mac(request.remote_addr, request.headers.get('X-Client-MAC'), request.headers.get('X-Proxy-Secret')) or mac
+    token = request.args.get('token') or (request.get_json(silent=True) or {}).get('token')
+    if not token and request.headers.get('Authorization', '').startswith('Bearer '):
+        token = request.headers['Authorization'][7:].strip()
+    payload, status = handle_check_auth(mac, client_address(request.remote_addr, request.headers.get('X-Forwarded-For'), request.headers.get('X-Proxy-Secret')), token)
+    return jsonify(payload), status
 
 @app.route('/api/stats', methods=['GET'])
 def api_stats():
-    cleanup_expired()
+    payload, status = handle_stats()
+    return jsonify(payload), status
+
+@app.route('/api/admin/otps', methods=['GET'])
+def api_admin_otps():
+    rejected = admin_rejection()
+    if rejected:
+        return rejected
+    payload, status = handle_admin_otps(
+        request.args.get('status'),
+        request.args.get('q'),
+        request.args.get('offset'),
+        request.args.get('limit')
+    )
+    return jsonify(payload), status
+
+@app.route('/api/admin/clients', methods=['GET'])
+def api_admin_clients():
+    rejected = admin_rejection()
+    if rejected:
+        return rejected
+    payload, status = handle_admin_clients(
+        request.args.get('router_status'),
+        request.args.get('q'),
+        request.args.get('offset'),
+        request.args.get('limit')
+    )
+    return jsonify(payload), status
+
+@app.route('/api/admin/bulk_auth', methods=['POST'])
+def api_admin_bulk_auth():
+    rejected = admin_rejection()
+    if rejected:
+        return rejected
+    items, options = bulk_request()
+    payload, status = handle_admin_bulk_auth(items, options.get('duration'), options.get('email'))
+    return jsonify(payload), status
+
+@app.route('/api/admin/bulk_deauth', methods=['POST'])
+def api_admin_bulk_deauth():
+    rejected = admin_rejection()
+    if rejected:
+        return rejected
+    items, options = bulk_request()
+    everyone = options.get('all') in (True, 'true', '1')
+    payload, status = handle_admin_bulk_deauth(items, everyone)
+    return jsonify(payload), status
+
+@app.route('/api/admin/events', methods=['GET'])
+def api_admin_events():
+    rejected = admin_rejection()
+    if rejected:
+        return rejected
+    return Response(event_stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics', methods=['GET'])
+def api_metrics():
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    request_latency.observe(time.perf_counter() - g.request_start, route)
+    request_count.inc(route, request.method, str(response.status_code))
+    return response
+
+CallbackMetric('otp_state_entries', 'Live OTPs, sessions and pending registrations', 'gauge',
+               lambda: {(table,): count for table, count in state_counts().items()}, ('table',))
+CallbackMetric('otp_issued_total', 'OTPs issued by this process', 'counter', lambda: state_counters['issued'])
+CallbackMetric('otp_verified_total', 'Successful OTP logins in this process', 'counter', lambda: state_counters['verified'])
+CallbackMetric('otp_expired_total', 'OTPs and sessions removed on expiry', 'counter', lambda: state_counters['expired'])
+CallbackMetric('otp_rate_limited_total', 'OTP requests rejected by the rate limiter', 'counter',
+               lambda: {(kind,): count for kind, count in rate_limiter.stats()['shed'].items()}, ('limit',))
+CallbackMetric('otp_email_queue_depth', 'OTP emails waiting for delivery', 'gauge', lambda: email_queue.queue.qsize())
+CallbackMetric('otp_emails_total', 'OTP email deliveries by result', 'counter',
+               lambda: {('sent',): email_queue.sent, ('failed',): email_queue.failed, ('rejected',): email_queue.rejected}, ('result',))
+CallbackMetric('otp_smtp_relay_up', 'SMTP relays currently in rotation (0 while cooling down)', 'gauge',
+               lambda: {(relay['relay'],): int(relay['healthy']) for relay in email_queue.stats()['relays']}, ('relay',))
+CallbackMetric('otp_smtp_relay_attempts_total', 'SMTP send attempts by relay and result', 'counter',
+               lambda: {(relay['relay'], result): relay[result] for relay in email_queue.stats()['relays'] for result in ('sent', 'failed')},
+               ('relay', 'result'))
+CallbackMetric('otp_router_pending', 'Router updates waiting to be batched', 'gauge', lambda: router_dispatcher.queue.qsize())
+CallbackMetric('otp_router_batches_total', 'Batched router calls sent', 'counter', lambda: router_dispatcher.batches)
+CallbackMetric('otp_neighbor_entries', 'IP to MAC entries synced from the router', 'gauge', lambda: len(neighbor_table.entries))
+CallbackMetric('otp_event_subscribers', 'Open dashboard event streams', 'gauge', lambda: len(event_broker.subscribers))
+
+def init_worker():
+    setup_logging()
+    init_state_backend()
+    start_expiry_reaper()
+    start_neighbor_sync()
+
+def run_prefork_server():
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("SERVER_WORKERS > 1 requires gunicorn (pip install gunicorn)")
+
+    if not STATE_SHARED:
+        raise SystemExit("SERVER_WORKERS > 1 requires STATE_BACKEND = 'sqlite' and STATE_SHARED = True")
 
-    return jsonify({
-        'active_otps': len([d for d in active_otps.values() if not d['used']]),
-        'used_otps': len([d for d in active_otps.values() if d['used']]),
-        'authenticated_clients': len(authenticated_clients),
-        'total_otps': len(active_otps),
-        'email_enabled': EMAIL_ENABLED
-    })
+    class PreforkServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{SERVER_HOST}:{SERVER_PORT}")
+            self.cfg.set('workers', SERVER_WORKERS)
+            self.cfg.set('threads', SERVER_THREADS)
+            self.cfg.set('post_fork', lambda server, worker: init_worker())
+
+        def load(self):
+            return app
+
+    PreforkServer().run()
+
+def run_server():
+    if SERVER_WORKERS > 1:
+        run_prefork_server()
+    else:
+        init_worker()
+        app.run(host=SERVER_HOST, port=SERVER_PORT, use_reloader=False)
 
 if __name__ == '__main__':
     print("=" * 70)
     print("🔐 OTP Authentication Server with Email Registration")
     print("=" * 70)
-    print(f"Server starting on http://0.0.0.0:5000")
+    print(f"Server starting on http://{SERVER_HOST}:{SERVER_PORT}")
     print(f"Admin Dashboard: http://192.168.1.246:5000")
     print(f"")
     print(f"Configuration:")
@@ -606,6 +2804,8 @@ if __name__ == '__main__':
     print(f"  - OTP Validity: {OTP_VALIDITY} seconds ({OTP_VALIDITY//60} minutes)")
     print(f"  - Session Duration: {SESSION_DURATION} seconds ({SESSION_DURATION//60} minutes)")
     print(f"  - Email Sending: {'ENABLED (Real emails)' if EMAIL_ENABLED else 'SIMULATION MODE (Console only)'}")
+    print(f"  - State Backend: {STATE_BACKEND}{f' ({STATE_DB_PATH})' if STATE_BACKEND == 'sqlite' else ''}{' shared' if STATE_SHARED else ''}")
+    print(f"  - Workers: {SERVER_WORKERS} process(es) x {SERVER_THREADS} threads" if SERVER_WORKERS > 1 else "  - Workers: 1 process (Flask development server)")
     print(f"")
     if not EMAIL_ENABLED:
         print("⚠️  EMAIL SIMULATION MODE")
@@ -613,4 +2813,4 @@ if __name__ == '__main__':
         print("  To enable real emails, configure SMTP settings in the script")
     print("=" * 70)
 
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    run_server()